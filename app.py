@@ -2,18 +2,101 @@ import streamlit as st
 import os
 import sqlite3
 import hashlib
+import hmac
+import html
+import json
 import re
+import string
 import datetime
+import threading
+import time
+import queue
+from contextlib import contextmanager
+from collections import deque
+from itertools import islice
+from io import BytesIO
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 from streamlit_cookies_manager import EncryptedCookieManager
 from google import genai
-from groq import Groq
+from groq import Groq, BadRequestError
 from dotenv import load_dotenv
-from PIL import Image
+from PIL import Image, ImageOps
 
 # --- 1. INITIALIZATION ---
 load_dotenv()
+DB_PATH = "nutrition_memory.db"
+DB_READ_POOL_SIZE = 4    # read-only connections shared by SELECT helpers
 MAX_RETRIES = 5          # max correction attempts
 CAL_TOLERANCE = 25 
+LLM_CACHE_TTL = "-1 day"          # how long a cached LLM reply stays valid
+LLM_CACHE_MAX_TEMPERATURE = 0.7   # at or above this, replies are never cached
+GROQ_REQUESTS_PER_MINUTE = 30     # Groq free-tier request limit, paced locally
+GROQ_MAX_RETRIES = 4              # SDK retries on 429/5xx, honouring Retry-After with backoff
+# Profile option lists shared by the sign-up and edit-profile widgets
+GENDERS = ("Male", "Female", "Other")
+ACTIVITY_LEVELS = ("Sedentary", "Active", "Very Active")
+DIET_TYPES = ("Vegetarian", "Non-Vegetarian", "Vegan")
+ACTIVITY_INDEX = {v: i for i, v in enumerate(ACTIVITY_LEVELS)}
+DIET_INDEX = {v: i for i, v in enumerate(DIET_TYPES)}
+ACTIVITY_MULTIPLIERS = dict(zip(ACTIVITY_LEVELS, (1.2, 1.55, 1.9)))  # TDEE = BMR x multiplier
+
+LIVE_CHAT_MAX_MESSAGES = 80      # chat turns kept in session memory
+CHAT_CACHE_MAX_ENTRIES = 32      # repeat-question replies kept per session, oldest dropped first
+FOOD_DIARY_MAX_ENTRIES = 30      # diary entries kept in session memory; all are stored in food_logs
+FOOD_LOG_ANALYSIS_MAX_CHARS = 400  # per diary entry in the carbon prompt
+FOOD_LOG_CONTEXT_MAX_CHARS = 3000  # whole diary block in the carbon prompt
+MEAL_IMAGE_MAX_SIDE = 1024        # longest edge sent to Gemini / shown in the tracker
+SCRYPT_PARAMS = dict(n=2**14, r=8, p=1, dklen=32)  # password KDF cost
+
+COST_CHARS = frozenset("0123456789.")  # kept by strip_cost when cleaning a cost string
+
+# Regexes compiled at module level instead of inside each call
+EMAIL_RE = re.compile(r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$")
+NUMBER_WORDS = {w: i for i, w in enumerate(("one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"), 1)}
+DURATION_REPLY_RE = re.compile(r"^\s*(\d{1,2}|" + "|".join(NUMBER_WORDS) + r")\s*(?:days?)?\s*[.!]?\s*$", re.IGNORECASE)
+# Only a leading imperative whose object is a new plan ("make me a 5 day diet plan"): the plan noun
+# follows a/an/new directly, and no "?" or "this/the/my plan" reference appears anywhere after it
+CREATE_PLAN_RE = re.compile(
+    r"^\s*(?:please\s+)?(?:make|create|generate|design|build)\s+(?:me\s+)?(?:a|an|new)\s+(?:new\s+)?"
+    r"(?:\d{1,2}[\s-]*days?\s+)?(?:(?:diet|meal)\s+)?plan\b"
+    r"(?![^?]*\b(?:this|the|that|current|my|your)\s+(?:diet\s+|meal\s+)?plan\b)[^?]*$",
+    re.IGNORECASE
+)
+DURATION_IN_TEXT_RE = re.compile(r"\b(\d{1,2})\s*-?\s*days?\b", re.IGNORECASE)
+MEALS_IN_TEXT_RE = re.compile(r"\b(\d)\s*meals?\b", re.IGNORECASE)
+ECO_REPORT_RE = re.compile(r"###\s*CO2:\s*([\d.]+)\s*###\s*###\s*SCORE:\s*(\d+)\s*###")
+ECO_CO2_RE = re.compile(r"###\s*CO2:\s*([\d.]+)")
+ECO_SCORE_RE = re.compile(r"###\s*SCORE:\s*(\d+)")
+ECO_MARKER_RE = re.compile(r"###.*?###")
+CHAT_NORMALIZE_RE = re.compile(r"[^a-z0-9]+")
+COST_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r"###\s*TOTAL_COST:\s*(\d[\d,]*)\s*###",  # With closing ###
+    r"###\s*TOTAL_COST:\s*(\d[\d,]*)",        # Without closing ###
+    r"TOTAL_COST:\s*(\d[\d,]*)",              # Without ### markers
+    r"Total Budget For Plan:\s*\[?₹?\s*(\d[\d,]*)",  # Manager Agent's closing line
+    r"Total Cost[:\s]+₹?\s*(\d[\d,]*)",       # Natural language format
+    r"Total[:\s]+₹?\s*(\d[\d,]*)",            # Just "Total:"
+    r"₹\s*(\d[\d,]*)",                         # Just currency symbol
+))
+COST_MARKER_PATTERNS = COST_PATTERNS[:3]  # TOTAL_COST marker only, no loose "Total"/"₹" fallbacks
+COST_LABELLED_PATTERNS = COST_PATTERNS[:4]  # marker or the Manager's "Total Budget For Plan" line
+# extract_calories / extract_protein run on lower-cased plan text, so no IGNORECASE
+CALORIE_TOTAL_PATTERNS = tuple(map(re.compile, (
+    r"total\s*[:\-]?\s*(\d{3,5})\s*kcal",
+    r"#\s*total\s*[:\-]?\s*(\d{3,5})",
+    r"total calories\s*[:\-]?\s*(\d{3,5})",
+)))
+# One alternation for every meal name; matches can't overlap, so a single findall sums the same hits
+MEAL_CALORIE_RE = re.compile(r"(?:breakfast|lunch|dinner|snacks?)\s*[:\-]?\s*(\d{2,4})\s*kcal")
+ANY_KCAL_RE = re.compile(r"(\d{2,4})\s*kcal")
+PROTEIN_TOTAL_PATTERNS = tuple(map(re.compile, (
+    r"day \d+ total.*?(\d+)\s*gm?\s*protein",
+    r"#\s*total.*?(\d+)\s*gm?\s*protein",
+    r"total.*?(\d+)\s*gm?\s*protein",
+)))
+DAY_PROTEIN_RE = re.compile(r"(?:Day \d+ Total|#Total).*?(\d+)\s*g\s*protein", re.IGNORECASE)
+
 st.set_page_config(page_title="Agentic Nutrition Planner", page_icon="🥗", layout="wide")
 
 cookies = EncryptedCookieManager(
@@ -26,15 +109,73 @@ if not cookies.ready():
     
 @st.cache_resource
 def get_groq_client():
-    return Groq(api_key=os.getenv("GROQ_API_KEY"))
+    return Groq(api_key=os.getenv("GROQ_API_KEY"), max_retries=GROQ_MAX_RETRIES)
+
+@st.cache_resource
+def get_groq_request_log():
+    # """Send times of the latest Groq requests from every session, plus the lock guarding them"""
+    return threading.Lock(), deque(maxlen=GROQ_REQUESTS_PER_MINUTE)
+
+def throttle_groq():
+    # Waits just long enough to stay under GROQ_REQUESTS_PER_MINUTE instead of running into a 429
+    lock, sent = get_groq_request_log()
+    with lock:
+        now = time.monotonic()
+        if len(sent) == sent.maxlen and sent[0] + 60 > now:
+            time.sleep(sent[0] + 60 - now)
+            now = time.monotonic()
+        sent.append(now)
 
+@st.cache_resource
+def get_genai_client():
+    return genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-genai_client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+# Resolved once per rerun; agent calls use these names instead of going back through the cache
+groq_client = get_groq_client()
+genai_client = get_genai_client()
 
 # --- 2. DATABASE & AUTH SYSTEM ---
-def init_db():
-    with sqlite3.connect('nutrition_memory.db') as conn:
+@st.cache_resource
+def get_db():
+    # """One long-lived connection shared by every session and rerun"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')  # 256 MB
+    conn.execute('PRAGMA cache_size=-20000')    # ~20 MB page cache
+    init_db(conn)  # schema setup rides on the one-time connection, not every rerun
+    return conn
+
+@st.cache_resource
+def get_db_lock():
+    # """Serializes writes on the shared connection across session threads"""
+    return threading.Lock()
+
+@st.cache_resource
+def get_read_pool():
+    # """Read-only connections, so concurrent SELECTs under WAL don't queue on the writer connection"""
+    get_db()  # read-only opens need the database file and schema to exist
+    pool = queue.LifoQueue()
+    for _ in range(DB_READ_POOL_SIZE):
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA cache_size=-8000')
+        pool.put(conn)
+    return pool
+
+@contextmanager
+def read_cursor():
+    # Borrows a pooled read connection for the duration of the block
+    pool = get_read_pool()
+    conn = pool.get()
+    try:
+        yield conn.cursor()
+    finally:
+        pool.put(conn)
+
+def init_db(conn):
+    with get_db_lock(), conn:
         c = conn.cursor()
         c.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -51,9 +192,13 @@ def init_db():
                 diet_type TEXT,
                 sleep REAL,
                 allergies TEXT,
-                cuisine TEXT
+                cuisine TEXT,
+                salt TEXT -- hex scrypt salt; NULL for legacy SHA-256 rows
             )
         ''')
+        # Databases created before scrypt hashing lack the salt column
+        if 'salt' not in [col[1] for col in c.execute('PRAGMA table_info(users)')]:
+            c.execute('ALTER TABLE users ADD COLUMN salt TEXT')
 
         c.execute('''
             CREATE TABLE IF NOT EXISTS diet_plans (
@@ -65,70 +210,179 @@ def init_db():
                 created_at TIMESTAMP
             )
         ''')
-        conn.commit()
+        # Serves get_approved_plans without a scan or sort; its leading email
+        # column also covers the DELETE in delete_user_account
+        c.execute('CREATE INDEX IF NOT EXISTS idx_plans_email_status_created ON diet_plans(email, status, created_at DESC)')
 
-def make_hashes(password): return hashlib.sha256(str.encode(password)).hexdigest()
-def check_hashes(password, hashed_text): return make_hashes(password) == hashed_text
-def is_valid_email(email): return re.match(r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$", email) is not None
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY, -- sha256 of model, temperature, messages
+                response TEXT,
+                created_at TIMESTAMP
+            )
+        ''')
+        # Expired replies are never read again; the index keeps the purge below and in store_cached_reply a range scan
+        c.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache(created_at)')
+        c.execute("DELETE FROM llm_cache WHERE created_at < datetime('now', ?)", (LLM_CACHE_TTL,))
+
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS food_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT,
+                analysis TEXT,
+                co2 REAL,
+                created_at TIMESTAMP
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_food_logs_email_created ON food_logs(email, created_at DESC)')
+        # Refreshes planner statistics (ANALYZE) only for tables whose indexes need it; cheap at startup
+        c.execute('PRAGMA optimize')
+
+class UserProfile(NamedTuple):
+    # Column order matches the users table, so the row factory can build it positionally
+    email: str
+    username: str
+    password: str
+    age: int
+    gender: str
+    height: float
+    weight: float
+    goal_weight: float
+    activity: str
+    meals_per_day: int
+    diet_type: str
+    sleep: float
+    allergies: str
+    cuisine: str
+
+def make_hashes(password, salt): return hashlib.scrypt(str.encode(password), salt=salt, **SCRYPT_PARAMS).hex()
+def check_hashes(password, hashed_text, salt_hex):
+    # Rows without a salt still hold the old unsalted SHA-256 digest
+    if salt_hex:
+        expected = make_hashes(password, bytes.fromhex(salt_hex))
+    else:
+        expected = hashlib.sha256(str.encode(password)).hexdigest()
+    return hmac.compare_digest(expected, hashed_text or "")
+def is_valid_email(email): return EMAIL_RE.match(email) is not None
 
 def add_user(email, username, password, age, gender, height, weight, goal_w, activity, meals, diet, sleep, allergies, cuisine):
+    conn = get_db()
     try:
-        with sqlite3.connect('nutrition_memory.db') as conn:
+        with get_db_lock(), conn:
             c = conn.cursor()
-            c.execute('INSERT INTO users VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', 
-                      (email, username, make_hashes(password), age, gender, height, weight, goal_w, activity, meals, diet, sleep, allergies, cuisine))
-            conn.commit()
-            return True
+            salt = os.urandom(16)
+            c.execute('INSERT INTO users VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', 
+                      (email, username, make_hashes(password, salt), age, gender, height, weight, goal_w, activity, meals, diet, sleep, allergies, cuisine, salt.hex()))
+        get_user_by_email.clear()
+        return True
     except sqlite3.IntegrityError:
         return False
 
 def login_user(email, password):
-    with sqlite3.connect('nutrition_memory.db') as conn:
+    with read_cursor() as c:
+        c.execute('SELECT password, salt FROM users WHERE email = ? LIMIT 1', (email,))
+        data = c.fetchone()
+    if data and check_hashes(password, data[0], data[1]):
+        if not data[1]:
+            set_password(email, password) # Upgrade legacy SHA-256 hash to scrypt
+        return get_user_by_email(email)
+    return False
+
+def set_password(email, password):
+    conn = get_db()
+    salt = os.urandom(16)
+    with get_db_lock(), conn:
         c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE email = ?', (email,))
-        data = c.fetchall()
-        if data and check_hashes(password, data[0][2]):
-            return data[0]
-        return False
+        c.execute('UPDATE users SET password=?, salt=? WHERE email=?', (make_hashes(password, salt), salt.hex(), email))
+    get_user_by_email.clear()
 
+@st.cache_data(ttl=300, show_spinner=False)
 def get_user_by_email(email):
-    with sqlite3.connect('nutrition_memory.db') as conn:
-        c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE email = ?', (email,))
-        data = c.fetchall()
-        return data[0] if data else None
+    with read_cursor() as c:
+        c.row_factory = lambda cursor, row: UserProfile(*row)
+        c.execute(f'SELECT {", ".join(UserProfile._fields)} FROM users WHERE email = ? LIMIT 1', (email,))
+        return c.fetchone()
 
 def save_diet_plan(email, plan_text, status, feedback=None):
-    with sqlite3.connect('nutrition_memory.db') as conn:
+    save_many_diet_plans([(email, plan_text, status, feedback)])
+
+def save_many_diet_plans(rows):
+    # """Inserts (email, plan_text, status, feedback) rows in one transaction, stamped by SQLite"""
+    conn = get_db()
+    with get_db_lock(), conn:
         c = conn.cursor()
-        c.execute('INSERT INTO diet_plans (email, plan_text, status, feedback, created_at) VALUES (?, ?, ?, ?, ?)',
-            (email, plan_text, status, feedback, datetime.datetime.now()))
-        conn.commit()
+        # Same local-time text layout the Python datetime adapter used to write, so old and new rows sort together
+        c.executemany(
+            "INSERT INTO diet_plans (email, plan_text, status, feedback, created_at) "
+            "VALUES (?, ?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))", rows
+        )
+    get_approved_plans.clear()
+    get_latest_approved_context.clear()
     
+@st.cache_data(ttl=300, show_spinner=False)
 def get_approved_plans(email):
-    with sqlite3.connect('nutrition_memory.db') as conn:
-        c = conn.cursor()
+    with read_cursor() as c:
         c.execute('SELECT created_at, plan_text FROM diet_plans WHERE email = ? AND status = "approved" ORDER BY created_at DESC', (email,))
-        data = c.fetchall()
-        return data
+        return c.fetchall()
+
+def save_food_log(email, entry):
+    conn = get_db()
+    with get_db_lock(), conn:
+        conn.execute('INSERT INTO food_logs (email, analysis, co2, created_at) VALUES (?, ?, ?, ?)',
+                     (email, entry["analysis"], entry["co2"], entry["timestamp"]))
+    get_food_log_context.clear()
+    get_low_impact_co2_total.clear()
+
+def get_recent_food_logs(email, n=5):
+    # """Latest n diary entries, oldest first, in the same shape as the in-memory food_diary"""
+    with read_cursor() as c:
+        c.execute('SELECT created_at, analysis, co2 FROM food_logs WHERE email = ? ORDER BY created_at DESC LIMIT ?', (email, n))
+        rows = c.fetchall()
+    return [{"timestamp": ts, "analysis": analysis, "co2": co2} for ts, analysis, co2 in reversed(rows)]
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_food_log_context(email, n=5):
+    # """Carbon-analysis prompt lines for the latest n diary entries; '' when there are none"""
+    # Gemini analyses can run long, so each is clipped and the oldest entries are dropped past the total cap
+    lines, total = [], 0
+    for f in reversed(get_recent_food_logs(email, n)):
+        line = f"- {f['analysis'][:FOOD_LOG_ANALYSIS_MAX_CHARS]} (CO₂: {f.get('co2', 'N/A')} kg)"
+        total += len(line) + 1
+        if lines and total > FOOD_LOG_CONTEXT_MAX_CHARS:
+            break
+        lines.append(line)
+    return "\n".join(reversed(lines))
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_low_impact_co2_total(email, n=5):
+    # """Summed CO2 (kg) of the same n entries as get_food_log_context when every one is a low-impact meal, else None"""
+    with read_cursor() as c:
+        c.execute('SELECT COUNT(*), COUNT(co2), SUM(co2), MAX(co2) FROM '
+                  '(SELECT co2 FROM food_logs WHERE email = ? ORDER BY created_at DESC LIMIT ?)', (email, n))
+        entries, estimated, total, highest = c.fetchone()
+    if entries and estimated == entries and highest <= LOW_IMPACT_MEAL_CO2_KG:
+        return float(total)
+    return None
 
 @st.cache_data(ttl=600)
 def get_latest_approved_context(email):
     # """Fetches the most recent approved plan to give context to the Chat Agent"""
-    plans = get_approved_plans(email)
-    if plans:
-        return plans[0][1] # Return the text of the latest plan
-    return "No previous approved plans."
+    with read_cursor() as c:
+        c.execute('SELECT plan_text FROM diet_plans WHERE email = ? AND status = "approved" ORDER BY created_at DESC LIMIT 1', (email,))
+        row = c.fetchone()
+    return row[0] if row else "No previous approved plans."
 
 def update_user_profile(email, age, gender, height, weight, goal_w, activity, meals, diet, sleep, allergies, cuisine):
-    with sqlite3.connect('nutrition_memory.db') as conn:
+    conn = get_db()
+    with get_db_lock(), conn:
         c = conn.cursor()
         c.execute('''
             UPDATE users SET 
             age=?, gender=?, height=?, weight=?, goal_weight=?, activity=?, meals_per_day=?, diet_type=?, sleep=?, allergies=?, cuisine=?
             WHERE email=?
         ''', (age, gender, height, weight, goal_w, activity, meals, diet, sleep, allergies, cuisine, email))
-        conn.commit()
+    get_user_by_email.clear()
+    user_targets.clear()
         
 def logout():
     cookies.pop("user_email", None)
@@ -139,28 +393,36 @@ def logout():
 
 
 def delete_user_account(email):
-    with sqlite3.connect('nutrition_memory.db') as conn:
-        c = conn.cursor()
-        c.execute('DELETE FROM diet_plans WHERE email = ?', (email,))
-        c.execute('DELETE FROM users WHERE email = ?', (email,))
-        conn.commit()
-    
-    
-@st.cache_resource
-def get_db():
-    return sqlite3.connect("nutrition_memory.db", check_same_thread=False)
-
-
-init_db()
+    conn = get_db()
+    # All deletes commit or roll back together; the plans go first, in the same write transaction
+    with get_db_lock(), conn:
+        conn.execute('DELETE FROM diet_plans WHERE email = ?', (email,))
+        conn.execute('DELETE FROM food_logs WHERE email = ?', (email,))
+        conn.execute('DELETE FROM users WHERE email = ?', (email,))
+    get_user_by_email.clear()
+    user_targets.clear()
+    get_approved_plans.clear()
+    get_latest_approved_context.clear()
+    get_food_log_context.clear()
+    get_low_impact_co2_total.clear()
 
 def calculate_needs(weight, height, age, gender, activity):
     if gender == "Male": bmr = (10 * weight) + (6.25 * height) - (5 * age) + 5
     else: bmr = (10 * weight) + (6.25 * height) - (5 * age) - 161
-    multipliers = {"Sedentary": 1.2, "Active": 1.55, "Very Active": 1.9}
-    return int(bmr * multipliers.get(activity, 1.2))
+    return int(bmr * ACTIVITY_MULTIPLIERS.get(activity, 1.2))
 
 def calculate_protein(weight): return weight*2
 
+def plan_objective(profile):
+    # """Plan goal passed to the agents: lose weight when above the goal weight, otherwise gain"""
+    return "Weight Loss" if profile.weight > profile.goal_weight else "Muscle Gain"
+
+@st.cache_data(ttl=600, show_spinner=False)
+def user_targets(email):
+    # """Daily TDEE and protein target for a stored profile, reused across plan regenerations"""
+    u = get_user_by_email(email)
+    return calculate_needs(u.weight, u.height, u.age, u.gender, u.activity), calculate_protein(u.weight)
+
 CAL_DB = {
     "roti": 110,
     "chapati": 110,
@@ -177,17 +439,385 @@ CAL_DB = {
 
 # --- 3. MULTI-AGENT ENGINE ---
 
-def run_agent(agent_role, agent_persona, user_context):
-    # """Generic function to call a specific agent"""
-    response = get_groq_client().chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=[
-            {"role": "system", "content": f"You are the {agent_role}. {agent_persona}"},
-            {"role": "user", "content": user_context}
-        ],
-        temperature=0.3
-    )
-    return response.choices[0].message.content
+# Invariant agent instructions, sent as the system prompt so the per-request
+# prompt only carries the user-specific targets, feedback and prior agent output
+REQUEST_ANALYSIS_RULES = """
+REQUEST ANALYSIS FIELDS (from the Request Analysis Agent, given as JSON in the request):
+- cost_target: STRICT total cost for the whole duration; stay inside acceptable_cost_range and spread daily_budget across the day's meals
+- max_cost: the user asked for a cheaper plan; keep the total at or below it using budget-friendly staples (Dal, Eggs, Soya, seasonal vegetables) instead of Paneer, Chicken, exotic or premium items, while maintaining protein
+- min_cost: the user allowed a bigger budget; the total may go up to it or more with premium ingredients, variety and better quality items
+- previous_cost with no other cost field: keep a similar cost range
+- items_to_avoid: DO NOT include these; find healthy, nutritionally equivalent, cost-effective alternatives
+- items_to_include: prioritize including these
+- preferences / constraints: respect all of them while maintaining nutrition
+- reasoning: how the user's request was interpreted
+"""
+
+JSON_AGENT_MAX_TOKENS = 300   # intent / request-analysis replies are a single small JSON object
+JSON_AGENT_PREAMBLE = "You are a precise JSON response agent. Always respond with valid JSON only, no markdown, no code blocks.\n"
+
+# Static instructions for detect_user_intent; the per-message state goes in the user turn
+INTENT_SYSTEM_PROMPT = JSON_AGENT_PREAMBLE + """
+You are an Intent Detection Agent for a Nutrition Planning System.
+IMPORTANT RULE:
+If the user message is a greeting, introduction, or small talk
+(e.g., "hi", "hello", "my name is X", "how are you"),
+the intent MUST be "GENERAL_QUESTION".
+DO NOT classify greetings as your actual task.
+
+TASK:
+Analyze the user's message and determine their intent. Respond with ONLY a JSON object in this exact format:
+
+{
+    "intent": "CREATE_PLAN" | "REGENERATE_PLAN" | "ANSWER_DURATION" | "GENERAL_QUESTION",
+    "confidence": 0.0-1.0,
+    "duration": <number or null>,
+    "meals_per_day": <number or null>,
+    "feedback": "<user's feedback text or null>",
+    "reasoning": "<brief explanation>"
+}
+
+INTENT DEFINITIONS:
+- CREATE_PLAN: User wants to create/generate a NEW diet plan (e.g., "make me a plan", "create diet", "I need a meal plan")
+- REGENERATE_PLAN: User wants to MODIFY/CHANGE the existing pending plan (e.g., "I don't have paneer", "replace chicken", "avoid eggs", "change this")
+- ANSWER_DURATION: User is answering a duration question with a number (only if the last assistant message was asking for duration)
+- GENERAL_QUESTION: Any other nutrition-related question or conversation
+
+EXTRACTION RULES:
+- Extract duration if mentioned (e.g., "3 days", "7 day plan", just "5")
+- Extract meals_per_day if mentioned (e.g., "4 meals", "3 meals per day")
+- For REGENERATE_PLAN, put the full user message in "feedback" field
+- Be smart: "I don't have X" = REGENERATE_PLAN, "make me a plan" = CREATE_PLAN
+"""
+
+# Static instructions for analyze_user_request; the feedback and cost/duration go in the user turn
+ANALYSIS_SYSTEM_PROMPT = JSON_AGENT_PREAMBLE + """
+You are a Request Analysis Agent for a Nutrition Planning System.
+
+YOUR TASK:
+Analyze the user's request completely and provide a structured analysis. Respond with ONLY a JSON object in this exact format:
+
+{
+    "cost_target": <number or null>,
+    "cost_adjustment": "increase" | "decrease" | "maintain" | "target",
+    "items_to_avoid": ["item1", "item2"],
+    "items_to_include": ["item1", "item2"],
+    "preferences": ["preference1", "preference2"],
+    "constraints": ["constraint1", "constraint2"],
+    "reasoning": "brief explanation of your analysis"
+}
+
+ANALYSIS GUIDELINES:
+
+1. COST ANALYSIS:
+- If user mentions a SPECIFIC amount (e.g., "cut to 200", "make it 500", "₹300"):
+    → Extract the number and set "cost_target" to that value
+    → Set "cost_adjustment" to "target"
+- If user says cost is too high/expensive/reduce:
+    → Set "cost_adjustment" to "decrease"
+    → If previous_cost exists, suggest 20-30% reduction
+- If user says they have budget/increase/premium:
+    → Set "cost_adjustment" to "increase"
+- If no cost mention: "maintain"
+
+2. ITEMS TO AVOID:
+- Extract any items user doesn't want/have/like
+- Examples: "don't have paneer" → ["paneer"]
+- "avoid eggs" → ["eggs"]
+- "no chicken" → ["chicken"]
+
+3. ITEMS TO INCLUDE:
+- Extract any items user specifically wants
+- Examples: "include more vegetables" → ["vegetables"]
+- "add fish" → ["fish"]
+
+4. PREFERENCES:
+- Extract dietary preferences, cuisine preferences, meal timing, etc.
+- Examples: "spicy food" → ["spicy"]
+- "light breakfast" → ["light breakfast"]
+
+5. CONSTRAINTS:
+- Extract any other constraints
+- Examples: "less oil" → ["less oil"]
+- "more protein" → ["more protein"]
+
+6. REASONING:
+- Brief explanation of how you interpreted the request
+
+CRITICAL:
+- Be thorough and extract ALL information from the user's request
+- If user says "cut cost to 200", cost_target MUST be 200
+- Understand context: "I don't have X" means avoid X
+- Be smart about synonyms and variations
+"""
+
+CHEF_SYSTEM_PROMPT = REQUEST_ANALYSIS_RULES + """
+DESIGN RULES:
+1. Each meal MUST be a COMPLETE combination (e.g., "2 Rotis + 150g Paneer Curry + Cucumber Salad + 200ml Milk")
+2. Calculate approximate calories as you design (use common food databases mentally)
+3. Choose quantities that naturally reach the calorie target (more rice/roti for calories, more protein sources for protein)
+
+EXAMPLE THOUGHT PROCESS:
+"For 840 kcal breakfast with 30g protein, I'll suggest:
+- 3 Rotis (330 kcal) + 2 Boiled Eggs (140 kcal) + 250ml Milk (150 kcal) + 1 Banana (105 kcal) + 30g Peanuts (170 kcal)
+Total: ~895 kcal, 35g protein ✓"
+"""
+
+BUDGET_SYSTEM_PROMPT = REQUEST_ANALYSIS_RULES + """
+REALITY CHECK:
+1. Assume user has Salt, Oil, Turmeric, & Spices.
+2. Budget for MAIN ingredients: Atta, Rice, Vegetables, Dal, Eggs/Paneer/Chicken, Milk, Curd.
+3. Market Rates: Eggs ₹7, Milk ₹32/500ml, Chicken ₹280/kg, Paneer ₹100/200g, Veg ₹40-60/kg.
+(use these items as only reference and not as you only have these items in the market, you can use wide range of items as well, but only healthy and nutritious items)
+
+VERIFICATION PROCESS:
+1. List each meal's calories and protein
+2. Sum them up for the day
+3. If UNDER target: Add calorie-dense items (nuts, banana, milk, extra roti)
+4. If OVER target: Reduce portion sizes slightly
+5. Output final totals in this EXACT format:
+#Total: XXXX kcal, XXg protein
+
+QUANTITY REQUIREMENTS:
+Every single item MUST have a specific quantity:
+- ✅ CORRECT: "3 Rotis (330 kcal)", "150g Chicken (250 kcal)", "250ml Milk (150 kcal)"
+- ❌ WRONG: "Rotis", "Chicken", "Milk"
+
+COST CALCULATION PROCESS:
+1. List ALL ingredients needed for the whole duration
+2. Calculate quantity needed for each ingredient
+3. Multiply quantity × market rate for each item
+4. Sum ALL costs to get total
+
+At the very end of your response, output the total cost in this EXACT format:
+### TOTAL_COST: 1500 ###
+(Replace 1500 with your calculated number. Only digits. No other text in this line.)
+"""
+
+MANAGER_SYSTEM_PROMPT = """
+Compile the Budget Agent's plan into a user-friendly plan.
+Take every number (weights, calorie & protein targets, per-meal targets, duration, cost) from the TARGETS section of the request.
+
+FORMAT:
+1. 🎯 HEALTH TARGETS
+    - Objective: (weight gain if current weight <= weight goal; else weight loss)
+    - Current weight
+    - Weight goal
+    - Daily required calories for user to reach goal
+    - Daily required protein for user to reach goal
+2. 🛍️ SHOPPING LIST
+3. 📅 DAILY MEAL PLAN (Day 1 to the last day)
+    FORMAT FOR EACH DAY:
+
+    **Day X:**
+
+    🌅 Breakfast (<breakfast target> kcal target):
+    - [Complete meal with quantities]
+    - Estimated: XXX kcal, XXg protein, XXg carbs, XXg fats
+
+    🌞 Lunch (<lunch target> kcal target):
+    - [Complete meal with quantities]
+    - Estimated: XXX kcal, XXg protein, XXg carbs, XXg fats
+
+    🌙 Dinner (<dinner target> kcal target):
+    - [Complete meal with quantities]
+    - Estimated: XXX kcal, XXg protein, XXg carbs, XXg fats
+
+    🍎 Snacks (<snacks target> kcal target):
+    - [Healthy snack with quantity]
+    - Estimated: XXX kcal, XXg protein, XXg carbs, XXg fats
+
+    📊 Day X Total: XXXX kcal, XXg protein, XXg carbs, XXg fats
+
+    CRITICAL: The sum of all meals should approximately equal the daily calorie and protein targets,
+    within the acceptable calorie range.
+4. 🔢 OVERALL SUMMARY
+    - Total Duration
+    - Average Daily Calories: Should be ~ the daily calorie target
+    - Average Daily Protein: Should be ~ the daily protein target
+5. 💰 TOTAL COST
+    (Display a warning about prices are not so accurate it may vary in real world)
+    IMPORTANT: Include the total cost in this EXACT format at the end:
+    # Total Budget For Plan: [₹number]
+    (e.g., ### Total Budget For Plan: [₹number] ###)
+6. FINAL VERDICT (it should be about meal and give message to consult a doctor if needed)
+"""
+
+# Per-request prompt bodies, built once; generate_plan_workflow only substitutes the user's values
+DOCTOR_PROMPT_TEMPLATE = string.Template("""
+User: ${age}yo, Current weight:${weight}kg, Goal: $goal_weight, Activity: $activity, Target${target_cals}kcal.
+Task: Validate these metrics.
+""")
+
+CHEF_PROMPT_TEMPLATE = string.Template("""
+Cuisine: $cuisine. Diet: $diet. Allergies: $allergies.
+
+***MANDATORY CALORIE & PROTEIN TARGETS (NON-NEGOTIABLE):***
+You MUST design meals that hit these EXACT targets:
+
+📊 DAILY TARGET: $target_cals kcal | ${tpro}g protein
+
+PER-MEAL BREAKDOWN (THIS IS YOUR CONTRACT):
+- Breakfast: $breakfast_cals kcal, ${breakfast_protein}g protein
+- Lunch: $lunch_cals kcal, ${lunch_protein}g protein
+- Dinner: $dinner_cals kcal, ${dinner_protein}g protein
+- Snacks: $snack_cals kcal, ${snack_protein}g protein
+
+MEAL STRUCTURE:
+- The user has $meals_per_day meals per day - split accordingly
+- Ensure HIGH VARIETY across $duration days
+
+$guidance_block
+
+Task: Draft a varied menu structure for $duration days based on the Request Analysis Agent's interpretation above.
+""")
+
+BUDGET_PROMPT_TEMPLATE = string.Template("""
+Duration: $duration Days.
+Menu Concept: $chef_output
+
+$guidance_block
+
+CRITICAL NUTRITION VALIDATION:
+Before finalizing, VERIFY your plan meets these targets:
+- Daily Total: $target_cals kcal (±50 kcal tolerance)
+- Daily Protein: ${tpro}g (±10g tolerance)
+
+***EXTREMELY IMPORTANT - COST CALCULATION:***
+$cost_instruction
+$cost_check
+
+Task:
+1. Create a CONSOLIDATED GROCERY LIST for $duration days.
+2. Calculate TOTAL ESTIMATED COST based on Request Analysis Agent's interpretation above.
+3. $cost_task
+4. Write the Final Meal Plan (Day 1 to $duration) WITH QUANTITIES.
+""")
+
+MANAGER_PROMPT_TEMPLATE = string.Template("""
+TARGETS:
+- Current weight: $weight kg
+- Weight goal: $goal_weight kg
+- Daily calories: $target_cals kcal (acceptable range: $cal_low to $cal_high kcal)
+- Daily protein: ${tpro}g
+- Per-meal targets: Breakfast $breakfast_cals kcal, Lunch $lunch_cals kcal, Dinner $dinner_cals kcal, Snacks $snack_cals kcal
+- Duration: Day 1 to Day $duration
+
+Doctor Targets: $doc_output
+Final Cost: $final_cost
+Final Plan: $plan_text
+""")
+
+# Budget Agent cost lines and persona, one variant for a fixed cost target and one without
+BUDGET_TARGET_COST_LINES = {
+    "cost_instruction": string.Template("TARGET COST: ₹$cost_target - Your final cost MUST be approximately ₹$cost_target (within ₹50 range)"),
+    "cost_check": string.Template("VERIFY: Total should be approximately ₹$cost_target. If not, adjust quantities and recalculate."),
+    "cost_task": string.Template("ENSURE total cost is approximately ₹$cost_target"),
+}
+BUDGET_OPEN_COST_LINES = {
+    "cost_instruction": "Calculate the total cost accurately based on all ingredients and quantities",
+    "cost_check": "Double-check your math",
+    "cost_task": "Calculate accurately",
+}
+BUDGET_TARGET_PERSONA_TEMPLATE = string.Template("""You are a PRECISE Budget Manager with a MANDATORY COST TARGET.
+            CRITICAL MISSION: Create a meal plan that costs EXACTLY ₹$cost_target total (approximately ₹$daily_budget per day).
+            - Your calculated ### TOTAL_COST: ### MUST be close to ₹$cost_target (within ₹50 range)
+            - Every ingredient and quantity choice must align with this budget
+            - Calculate carefully: if your cost doesn't match, REVISE your plan
+            - Maintain nutritional balance and target calories of $target_cals per day within this strict budget
+            - This is NOT a suggestion - it's a REQUIREMENT from the Request Analysis Agent""")
+BUDGET_PERSONA_TEMPLATE = string.Template("""You are an Intelligent Budget & Nutrition Manager. 
+            Your role is to follow the Request Analysis Agent's interpretation and optimize the meal plan accordingly.
+            - Follow the cost adjustment guidance from Request Analysis Agent
+            - Respect items to avoid/include from Request Analysis Agent
+            - Always maintain nutritional balance and ensure meals reach target calories of $target_cals per day
+            - Be adaptive based on the Request Analysis Agent's structured output""")
+
+@st.cache_resource
+def get_agent_executor():
+    # """Shared worker pool for agent calls that can overlap their network round-trips"""
+    return ThreadPoolExecutor(max_workers=4)
+
+def cached_chat(messages, model="llama-3.1-8b-instant", temperature=0.3, **params):
+    """
+    Groq chat completion backed by the llm_cache table.
+    Identical (model, temperature, messages, params) requests return the stored reply
+    instead of another round-trip. Calls at temperature >= LLM_CACHE_MAX_TEMPERATURE
+    are meant to vary, so they always go to the API.
+    """
+    if temperature >= LLM_CACHE_MAX_TEMPERATURE:
+        throttle_groq()
+        response = groq_client.chat.completions.create(model=model, messages=messages, temperature=temperature, **params)
+        return response.choices[0].message.content
+
+    key = llm_cache_key(model, temperature, messages, params)
+    cached = get_cached_reply(key)
+    if cached is not None:
+        return cached
+
+    throttle_groq()
+    response = groq_client.chat.completions.create(model=model, messages=messages, temperature=temperature, **params)
+    content = response.choices[0].message.content
+    store_cached_reply(key, content)
+    return content
+
+def cached_chat_stream(messages, model="llama-3.1-8b-instant", temperature=0.3, **params):
+    """
+    Streaming counterpart of cached_chat: yields text chunks as Groq produces them,
+    and stores the assembled reply once the stream completes. A cache hit is
+    yielded as a single chunk.
+    """
+    cacheable = temperature < LLM_CACHE_MAX_TEMPERATURE
+    key = llm_cache_key(model, temperature, messages, params) if cacheable else None
+    if cacheable:
+        cached = get_cached_reply(key)
+        if cached is not None:
+            yield cached
+            return
+
+    throttle_groq()
+    stream = groq_client.chat.completions.create(model=model, messages=messages, temperature=temperature, stream=True, **params)
+    parts = []
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
+    if cacheable:
+        store_cached_reply(key, "".join(parts))
+
+def llm_cache_key(model, temperature, messages, params):
+    return hashlib.sha256(json.dumps([model, temperature, messages, params], sort_keys=True).encode()).hexdigest()
+
+def get_cached_reply(key):
+    with read_cursor() as c:
+        c.execute("SELECT response FROM llm_cache WHERE key = ? AND created_at >= datetime('now', ?)", (key, LLM_CACHE_TTL))
+        row = c.fetchone()
+    return row[0] if row else None
+
+def store_cached_reply(key, content):
+    conn = get_db()
+    with get_db_lock(), conn:
+        conn.execute("INSERT OR REPLACE INTO llm_cache (key, response, created_at) VALUES (?, ?, datetime('now'))", (key, content))
+        # INSERT OR REPLACE only overwrites the same key, so expired rows are deleted here or the table only grows
+        conn.execute("DELETE FROM llm_cache WHERE created_at < datetime('now', ?)", (LLM_CACHE_TTL,))
+
+def agent_messages(agent_role, agent_persona, user_context, instructions=None):
+    # Static instructions go first so the prompt prefix is identical across calls
+    messages = [{"role": "system", "content": instructions}] if instructions else []
+    messages += [
+        {"role": "system", "content": f"You are the {agent_role}. {agent_persona}"},
+        {"role": "user", "content": user_context}
+    ]
+    return messages
+
+def run_agent(agent_role, agent_persona, user_context, instructions=None, **params):
+    # """Generic function to call a specific agent; extra params (e.g. response_format) go to Groq"""
+    return cached_chat(agent_messages(agent_role, agent_persona, user_context, instructions), temperature=0.3, **params)
+
+def run_agent_stream(agent_role, agent_persona, user_context, instructions=None):
+    # """Same as run_agent, but yields the reply chunk by chunk for st.write_stream"""
+    return cached_chat_stream(agent_messages(agent_role, agent_persona, user_context, instructions), temperature=0.3)
 
 def extract_calories(plan_text: str) -> int:
     """
@@ -206,14 +836,8 @@ def extract_calories(plan_text: str) -> int:
     # --------------------------------------------------
     # 1️⃣ STRONG SIGNAL: Explicit daily total
     # --------------------------------------------------
-    explicit_patterns = [
-        r"total\s*[:\-]?\s*(\d{3,5})\s*kcal",
-        r"#\s*total\s*[:\-]?\s*(\d{3,5})",
-        r"total calories\s*[:\-]?\s*(\d{3,5})",
-    ]
-
-    for pattern in explicit_patterns:
-        match = re.search(pattern, text)
+    for pattern in CALORIE_TOTAL_PATTERNS:
+        match = pattern.search(text)
         if match:
             try:
                 return int(match.group(1))
@@ -223,23 +847,15 @@ def extract_calories(plan_text: str) -> int:
     # --------------------------------------------------
     # 2️⃣ MEDIUM SIGNAL: Meal-wise calories
     # --------------------------------------------------
-    meal_patterns = [
-        r"breakfast\s*[:\-]?\s*(\d{2,4})\s*kcal",
-        r"lunch\s*[:\-]?\s*(\d{2,4})\s*kcal",
-        r"dinner\s*[:\-]?\s*(\d{2,4})\s*kcal",
-        r"snacks?\s*[:\-]?\s*(\d{2,4})\s*kcal",
-    ]
-
     total = 0
     found_any = False
 
-    for pattern in meal_patterns:
-        for match in re.findall(pattern, text):
-            try:
-                total += int(match)
-                found_any = True
-            except ValueError:
-                continue
+    for match in MEAL_CALORIE_RE.findall(text):
+        try:
+            total += int(match)
+            found_any = True
+        except ValueError:
+            continue
 
     if found_any:
         return total
@@ -247,14 +863,18 @@ def extract_calories(plan_text: str) -> int:
     # --------------------------------------------------
     # 3️⃣ WEAK FALLBACK: Any kcal mentions (guarded)
     # --------------------------------------------------
-    all_kcals = re.findall(r"(\d{2,4})\s*kcal", text)
-    numeric_kcals = [int(x) for x in all_kcals if 50 <= int(x) <= 2000]
-
-    if numeric_kcals:
-        # Avoid double counting: sum only if reasonable
-        summed = sum(numeric_kcals)
-        if summed <= 6000:   # sanity cap
-            return summed
+    # One pass: each number parsed once, and a running total past the sanity cap means
+    # the mentions are double counting, so give up right away
+    summed = 0
+    for match in ANY_KCAL_RE.finditer(text):
+        kcal = int(match.group(1))
+        if 50 <= kcal <= 2000:
+            summed += kcal
+            if summed > 6000:   # sanity cap
+                return 0
+
+    if summed:
+        return summed
 
     # --------------------------------------------------
     # 4️⃣ LAST RESORT
@@ -271,15 +891,9 @@ def extract_protein(plan_text: str) -> int:
     
     text = plan_text.lower()
     
-    # Pattern 1: Explicit daily total
-    patterns = [
-        r"day \d+ total.*?(\d+)\s*g(?:m)?\s*protein",
-        r"#\s*total.*?(\d+)\s*g(?:m)?\s*protein",
-        r"total.*?(\d+)\s*g(?:m)?\s*protein",
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text)
+    # Explicit daily total, most specific pattern first
+    for pattern in PROTEIN_TOTAL_PATTERNS:
+        match = pattern.search(text)
         if match:
             try:
                 return int(match.group(1))
@@ -288,13 +902,83 @@ def extract_protein(plan_text: str) -> int:
     
     return 0
 
+def strip_cost(text) -> str:
+    # """Keeps only digits and '.', e.g. '₹1,500' -> '1500'; a C-level filter, no regex pass"""
+    return "".join(filter(COST_CHARS.__contains__, text))
+
+def extract_cost(*texts, patterns=COST_PATTERNS) -> str:
+    """
+    Extract the total plan cost as a digit string, trying each text in order.
+    Patterns in COST_PATTERNS go from the strict '### TOTAL_COST: N ###' marker
+    down to a bare '₹N'; the first hit wins. Returns "0" if nothing matches.
+    """
+    for text in texts:
+        for pattern in patterns:
+            cost_match = pattern.search(text)
+            if cost_match:
+                return cost_match.group(1).replace(",", "")
+    return "0"
+
+def find_json_object(text, required_key):
+    """
+    Returns (obj, start, end) for the first JSON object in text that contains
+    required_key, or None. Scans each '{' with raw_decode, so nested braces and
+    surrounding markdown or prose don't break parsing.
+    """
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    while start != -1:
+        try:
+            obj, end = decoder.raw_decode(text, start)
+            if isinstance(obj, dict) and required_key in obj:
+                return obj, start, end
+        except json.JSONDecodeError:
+            pass
+        start = text.find("{", start + 1)
+    return None
+
+def extract_json_object(text, required_key):
+    # Same as find_json_object, but only the object, and a ValueError when there is none
+    found = find_json_object(text, required_key)
+    if found is None:
+        raise ValueError(f"No JSON object with '{required_key}' found in response")
+    return found[0]
+
+def fast_path_intent(user_message, has_pending_plan, last_was_duration_question):
+    """
+    Keyword classifier for the unambiguous messages, tried before the LLM agent.
+    Returns an intent dict in the same shape as detect_user_intent, or None
+    when the message should go to the LLM. With a plan pending, plan requests
+    always go to the LLM, since keywords cannot tell a new plan from a change.
+    """
+    def intent(name, reasoning, duration=None, meals=None, feedback=None):
+        return {"intent": name, "confidence": 1.0, "duration": duration, "meals_per_day": meals,
+                "feedback": feedback, "reasoning": reasoning}
+
+    # A bare number ("5", "5 days", "seven") right after the duration question
+    duration_reply = DURATION_REPLY_RE.match(user_message) if last_was_duration_question else None
+    if duration_reply:
+        days = duration_reply.group(1).lower()
+        return intent("ANSWER_DURATION", "Numeric reply to the duration question", duration=NUMBER_WORDS.get(days) or int(days))
+
+    # "make me a 5 day diet plan with 4 meals"
+    if not has_pending_plan and CREATE_PLAN_RE.match(user_message):
+        duration = DURATION_IN_TEXT_RE.search(user_message)
+        meals = MEALS_IN_TEXT_RE.search(user_message)
+        return intent("CREATE_PLAN", "Explicit plan request",
+                      duration=int(duration.group(1)) if duration else None,
+                      meals=int(meals.group(1)) if meals else None)
+
+    return None
+
 def detect_user_intent(user_message, chat_history, has_pending_plan):
     """
     AI-Powered Intent Detection Agent
     Analyzes user message and determines the intent dynamically.
     Returns structured intent information.
     """
-    # Build context about current state
+    # The prompt depends only on the message and these two state flags (not the rolling
+    # chat history), so a repeated request is answered from llm_cache
     state_context = ""
     if has_pending_plan:
         state_context = "There is currently a PROPOSED diet plan displayed on screen (not yet approved)."
@@ -307,74 +991,33 @@ def detect_user_intent(user_message, chat_history, has_pending_plan):
         last_assistant_msg = chat_history[-2].get("content", "") if chat_history[-2].get("role") == "assistant" else ""
         if "how many days" in last_assistant_msg.lower():
             last_was_duration_question = True
-            
+
+    # Clear-cut messages need no LLM classification
+    fast_intent = fast_path_intent(user_message, has_pending_plan, last_was_duration_question)
+    if fast_intent:
+        return fast_intent
     
     intent_prompt = f"""
-    You are an Intent Detection Agent for a Nutrition Planning System.
-    IMPORTANT RULE:
-    If the user message is a greeting, introduction, or small talk 
-    (e.g., "hi", "hello", "my name is X", "how are you"),
-    the intent MUST be "GENERAL_QUESTION".
-    DO NOT classify greetings as your actual task.
-
     CURRENT STATE:
     {state_context}
     Last assistant message was asking for duration: {last_was_duration_question}
 
     USER MESSAGE: "{user_message}"
-
-    CHAT HISTORY (last 3 messages):
-    {str(chat_history[-3:]) if len(chat_history) >= 3 else str(chat_history)}
-
-    TASK:
-    Analyze the user's message and determine their intent. Respond with ONLY a JSON object in this exact format:
-
-    {{
-        "intent": "CREATE_PLAN" | "REGENERATE_PLAN" | "ANSWER_DURATION" | "GENERAL_QUESTION",
-        "confidence": 0.0-1.0,
-        "duration": <number or null>,
-        "meals_per_day": <number or null>,
-        "feedback": "<user's feedback text or null>",
-        "reasoning": "<brief explanation>"
-    }}
-
-    INTENT DEFINITIONS:
-    - CREATE_PLAN: User wants to create/generate a NEW diet plan (e.g., "make me a plan", "create diet", "I need a meal plan")
-    - REGENERATE_PLAN: User wants to MODIFY/CHANGE the existing pending plan (e.g., "I don't have paneer", "replace chicken", "avoid eggs", "change this")
-    - ANSWER_DURATION: User is answering a duration question with a number (only if last_was_duration_question is True)
-    - GENERAL_QUESTION: Any other nutrition-related question or conversation
-
-    EXTRACTION RULES:
-    - Extract duration if mentioned (e.g., "3 days", "7 day plan", just "5")
-    - Extract meals_per_day if mentioned (e.g., "4 meals", "3 meals per day")
-    - For REGENERATE_PLAN, put the full user message in "feedback" field
-    - Be smart: "I don't have X" = REGENERATE_PLAN, "make me a plan" = CREATE_PLAN
-
-    Respond with ONLY the JSON, no other text.
     """
         
     try:
-        import json
-        import re
-        
-        response = get_groq_client().chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[
-                {"role": "system", "content": "You are a precise JSON response agent. Always respond with valid JSON only, no markdown, no code blocks."},
+        response_text = cached_chat(
+            [
+                {"role": "system", "content": INTENT_SYSTEM_PROMPT},
                 {"role": "user", "content": intent_prompt}
             ],
-            temperature=0.2
-        )
-        
-        response_text = response.choices[0].message.content.strip()
-        
-        # Try to extract JSON if wrapped in code blocks or markdown
-        json_match = re.search(r'\{[^{}]*"intent"[^{}]*\}', response_text, re.DOTALL)
-        if json_match:
-            response_text = json_match.group(0)
+            temperature=0,
+            max_tokens=JSON_AGENT_MAX_TOKENS,
+            response_format={"type": "json_object"}
+        ).strip()
         
-        # Parse JSON
-        intent_data = json.loads(response_text)
+        # Parse the JSON object, even if wrapped in code blocks or markdown
+        intent_data = extract_json_object(response_text, "intent")
         
         # Validate required fields
         if "intent" not in intent_data:
@@ -410,93 +1053,24 @@ def analyze_user_request(user_feedback, previous_cost=None, duration=None):
         }
     
     analysis_prompt = f"""
-    You are a Request Analysis Agent for a Nutrition Planning System.
-
     USER FEEDBACK: "{user_feedback}"
     {f"PREVIOUS PLAN COST: ₹{previous_cost} for {duration} days" if previous_cost else "NO PREVIOUS PLAN"}
     {f"DURATION: {duration} days" if duration else ""}
-
-    YOUR TASK:
-    Analyze the user's request completely and provide a structured analysis. Respond with ONLY a JSON object in this exact format:
-
-    {{
-        "cost_target": <number or null>,
-        "cost_adjustment": "increase" | "decrease" | "maintain" | "target",
-        "items_to_avoid": ["item1", "item2"],
-        "items_to_include": ["item1", "item2"],
-        "preferences": ["preference1", "preference2"],
-        "constraints": ["constraint1", "constraint2"],
-        "reasoning": "brief explanation of your analysis"
-    }}
-
-    ANALYSIS GUIDELINES:
-
-    1. COST ANALYSIS:
-    - If user mentions a SPECIFIC amount (e.g., "cut to 200", "make it 500", "₹300"):
-        → Extract the number and set "cost_target" to that value
-        → Set "cost_adjustment" to "target"
-    - If user says cost is too high/expensive/reduce:
-        → Set "cost_adjustment" to "decrease"
-        → If previous_cost exists, suggest 20-30% reduction
-    - If user says they have budget/increase/premium:
-        → Set "cost_adjustment" to "increase"
-    - If no cost mention: "maintain"
-
-    2. ITEMS TO AVOID:
-    - Extract any items user doesn't want/have/like
-    - Examples: "don't have paneer" → ["paneer"]
-    - "avoid eggs" → ["eggs"]
-    - "no chicken" → ["chicken"]
-
-    3. ITEMS TO INCLUDE:
-    - Extract any items user specifically wants
-    - Examples: "include more vegetables" → ["vegetables"]
-    - "add fish" → ["fish"]
-
-    4. PREFERENCES:
-    - Extract dietary preferences, cuisine preferences, meal timing, etc.
-    - Examples: "spicy food" → ["spicy"]
-    - "light breakfast" → ["light breakfast"]
-
-    5. CONSTRAINTS:
-    - Extract any other constraints
-    - Examples: "less oil" → ["less oil"]
-    - "more protein" → ["more protein"]
-
-    6. REASONING:
-    - Brief explanation of how you interpreted the request
-
-    CRITICAL: 
-    - Be thorough and extract ALL information from the user's request
-    - If user says "cut cost to 200", cost_target MUST be 200
-    - Understand context: "I don't have X" means avoid X
-    - Be smart about synonyms and variations
-
-    Respond with ONLY the JSON, no other text.
     """
     
     try:
-        import json
-        import re
-        
-        response = get_groq_client().chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[
-                {"role": "system", "content": "You are a precise JSON response agent. Always respond with valid JSON only, no markdown, no code blocks."},
+        response_text = cached_chat(
+            [
+                {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
                 {"role": "user", "content": analysis_prompt}
             ],
-            temperature=0.2
-        )
-        
-        response_text = response.choices[0].message.content.strip()
+            temperature=0,
+            max_tokens=JSON_AGENT_MAX_TOKENS,
+            response_format={"type": "json_object"}
+        ).strip()
         
-        # Try to extract JSON if wrapped in code blocks or markdown
-        json_match = re.search(r'\{[^{}]*"cost_target"[^{}]*\}', response_text, re.DOTALL)
-        if json_match:
-            response_text = json_match.group(0)
-        
-        # Parse JSON
-        analysis = json.loads(response_text)
+        # Parse the JSON object, even if wrapped in code blocks or markdown
+        analysis = extract_json_object(response_text, "cost_target")
         
         # Validate required fields
         required_fields = ["cost_target", "cost_adjustment", "items_to_avoid", "items_to_include", "preferences", "constraints", "reasoning"]
@@ -525,106 +1099,65 @@ def analyze_user_request(user_feedback, previous_cost=None, duration=None):
             "reasoning": f"Error analyzing request: {str(e)}"
         }
 
-def generate_plan_workflow(email, age, weight, height, gender, act, goal, duration, cuisine, diet, allergy, meals_per_day, feedback=None, previous_cost=None):
+def build_request_guidance(request_analysis, duration, previous_cost=None):
+    """
+    Serializes the Request Analysis Agent output into one JSON block for the Chef and
+    Budget prompts. Cost limits that depend on the previous plan are resolved here
+    (daily budget, acceptable range, 25% cut or 20% raise) so the agents get numbers,
+    not rules. REQUEST_ANALYSIS_RULES in the system prompts explains each field.
+    """
+    guidance = dict(request_analysis, duration_days=duration)
+    cost_target = request_analysis["cost_target"]
+    if previous_cost:
+        guidance["previous_cost"] = previous_cost
+    if cost_target:
+        guidance["daily_budget"] = round(cost_target / duration, 2)
+        guidance["acceptable_cost_range"] = [int(cost_target - 50), int(cost_target + 50)]
+    elif request_analysis["cost_adjustment"] == "decrease" and previous_cost:
+        guidance["max_cost"] = int(previous_cost * 0.75)
+    elif request_analysis["cost_adjustment"] == "increase" and previous_cost:
+        guidance["min_cost"] = int(previous_cost * 1.2)
+    return "### REQUEST ANALYSIS (follow strictly):\n```json\n" + json.dumps(guidance, ensure_ascii=False) + "\n```"
+
+def generate_plan_workflow(profile, goal, duration, meals_per_day, feedback=None, previous_cost=None):
     """
     This function runs the entire Multi-Agent Chain.
     It returns the Final Plan Text and the Total Cost.
+    profile: the signed-in user's UserProfile (body stats, diet, cuisine, allergies)
     feedback: Optional user feedback to incorporate into plan generation (e.g., "I don't have paneer", "cost is too high")
     previous_cost: Optional previous plan cost for relative cost adjustment
     """
     
     with st.status("🕵️ Agent Panel Coordinating...", expanded=True) as status:
+        # One placeholder for the step log, redrawn in place instead of appending an element per step
+        progress = st.empty()
+        steps = []
+        def log_step(msg):
+            steps.append(msg)
+            progress.markdown("\n\n".join(steps))
+
+        tdee, tpro = user_targets(profile.email)
+        target_cals = tdee + 300 if "Gain" in goal else tdee - 400 if "Loss" in goal else tdee
+
+        log_step("👨‍⚕️ Doctor Agent: Setting Metabolic Targets...")
+
+        doc_prompt = DOCTOR_PROMPT_TEMPLATE.substitute(
+            age=profile.age, weight=profile.weight, goal_weight=profile.goal_weight,
+            activity=profile.activity, target_cals=target_cals
+        )
+        # Doctor output is only needed by the Manager Agent, so it runs in the
+        # background while Request Analysis, Chef and Budget agents proceed
+        doc_future = get_agent_executor().submit(run_agent, "Doctor Agent", "You are a strict Clinical Doctor.", doc_prompt)
 
-        st.write("🔍 Request Analysis Agent: Analyzing User Request...")
+        log_step("🔍 Request Analysis Agent: Analyzing User Request...")
         
         # Request Analysis Agent - Fully AI-driven interpretation
         request_analysis = analyze_user_request(feedback, previous_cost, duration)
-        
-        st.write("👨‍⚕️ Doctor Agent: Setting Metabolic Targets...")
-        
-        tdee = calculate_needs(u_data[6], u_data[5], u_data[3], u_data[4], u_data[8])
-        tpro = calculate_protein(u_data[6])
-        target_cals = tdee + 300 if "Gain" in goal else tdee - 400 if "Loss" in goal else tdee
-
-        doc_prompt = f"""
-        User: {u_data[3]}yo, Current weight:{u_data[6]}kg, Goal: {u_data[7]}, Activity: {u_data[8]}, Target{target_cals}kcal.
-        Task: Validate these metrics.
-        """
-        doc_output = run_agent("Doctor Agent", "You are a strict Clinical Doctor.", doc_prompt)
     
-        st.write("👨‍🍳 Chef Agent: Designing Complete Meals...")
-        
-        # Build Chef Agent prompt from Request Analysis Agent output
-        cost_guidance = ""
-        if request_analysis["cost_target"]:
-            cost_guidance = f"""
-        
-        ***MANDATORY COST TARGET (from Request Analysis):***
-        - Target Cost: ₹{request_analysis["cost_target"]} total for {duration} days
-        - Daily Budget: ₹{request_analysis["cost_target"]/duration:.2f} per day
-        - This is a STRICT REQUIREMENT - design meals within this budget
-        - Split ₹{request_analysis["cost_target"]/duration:.2f} across {meals_per_day} meals per day
-        - Use budget-friendly ingredients: Dal, Eggs, seasonal vegetables, basic staples
-        - AVOID expensive items: Paneer, Chicken, exotic vegetables, premium items
-        """
-        elif request_analysis["cost_adjustment"] == "decrease" and previous_cost:
-            target_reduction = int(previous_cost * 0.75)
-            cost_guidance = f"""
-        
-        ***COST REDUCTION REQUIRED (from Request Analysis):***
-        - Previous cost: ₹{previous_cost}
-        - Target: Reduce to approximately ₹{target_reduction} or less (20-30% reduction)
-        - Use budget-friendly ingredients and avoid expensive items
-        """
-        elif request_analysis["cost_adjustment"] == "increase" and previous_cost:
-            target_increase = int(previous_cost * 1.2)
-            cost_guidance = f"""
-        
-        ***COST INCREASE ALLOWED (from Request Analysis):***
-        - Previous cost: ₹{previous_cost}
-        - You can increase to ₹{target_increase} or more
-        - Include premium ingredients, variety, better quality items
-        """
-        
-        items_guidance = ""
-        if request_analysis["items_to_avoid"]:
-            items_guidance += f"""
-        
-        ***ITEMS TO AVOID (from Request Analysis):***
-        - DO NOT include these items: {", ".join(request_analysis["items_to_avoid"])}
-        - Find healthy, nutritionally equivalent alternatives
-        """
+        log_step("👨‍🍳 Chef Agent: Designing Complete Meals...")
         
-        if request_analysis["items_to_include"]:
-            items_guidance += f"""
-        
-        ***ITEMS TO INCLUDE (from Request Analysis):***
-        - Prioritize including: {", ".join(request_analysis["items_to_include"])}
-        """
-        
-        preferences_guidance = ""
-        if request_analysis["preferences"]:
-            preferences_guidance = f"""
-        
-        ***PREFERENCES (from Request Analysis):***
-        - User preferences: {", ".join(request_analysis["preferences"])}
-        - Incorporate these preferences into meal design
-        """
-        
-        constraints_guidance = ""
-        if request_analysis["constraints"]:
-            constraints_guidance = f"""
-        
-        ***CONSTRAINTS (from Request Analysis):***
-        - Additional constraints: {", ".join(request_analysis["constraints"])}
-        - Respect all constraints while maintaining nutrition
-        """
-        
-        analysis_summary = f"""
-        
-        ***REQUEST ANALYSIS SUMMARY:***
-        {request_analysis["reasoning"]}
-        """
+        # Request Analysis output (plus derived cost limits) shared by Chef and Budget agents
+        guidance_block = build_request_guidance(request_analysis, duration, previous_cost)
         
         breakfast_cals = int(target_cals * 0.30)  # 30% for breakfast
         lunch_cals = int(target_cals * 0.40)      # 40% for lunch
@@ -637,256 +1170,74 @@ def generate_plan_workflow(email, age, weight, height, gender, act, goal, durati
         dinner_protein = int(tpro * 0.30)     # 30% for dinner
         snack_protein = tpro - (breakfast_protein + lunch_protein + dinner_protein)  # Remaining for snacks
         
-        chef_prompt = f"""
-        Cuisine: {u_data[13]}. Diet: {u_data[10]}. Allergies: {u_data[12]}.
-
-        ***MANDATORY CALORIE & PROTEIN TARGETS (NON-NEGOTIABLE):***
-        You MUST design meals that hit these EXACT targets:
-
-        📊 DAILY TARGET: {target_cals} kcal | {tpro}g protein
-
-        PER-MEAL BREAKDOWN (THIS IS YOUR CONTRACT):
-        - Breakfast: {breakfast_cals} kcal, {breakfast_protein}g protein
-        - Lunch: {lunch_cals} kcal, {lunch_protein}g protein  
-        - Dinner: {dinner_cals} kcal, {dinner_protein}g protein
-        - Snacks: {snack_cals} kcal, {snack_protein}g protein
-
-        DESIGN RULES:
-        1. Each meal MUST be a COMPLETE combination (e.g., "2 Rotis + 150g Paneer Curry + Cucumber Salad + 200ml Milk")
-        2. Calculate approximate calories as you design (use common food databases mentally)
-        3. Choose quantities that naturally reach the calorie target (more rice/roti for calories, more protein sources for protein)
-        4. The user has {meals_per_day} meals per day - split accordingly
-        5. Ensure HIGH VARIETY across {duration} days
-
-        EXAMPLE THOUGHT PROCESS:
-        "For 840 kcal breakfast with 30g protein, I'll suggest:
-        - 3 Rotis (330 kcal) + 2 Boiled Eggs (140 kcal) + 250ml Milk (150 kcal) + 1 Banana (105 kcal) + 30g Peanuts (170 kcal)
-        Total: ~895 kcal, 35g protein ✓"
-        
-        {analysis_summary}
-        {cost_guidance}
-        {items_guidance}
-        {preferences_guidance}
-        {constraints_guidance}
-        
-        Task: Draft a varied menu structure for {duration} days based on the Request Analysis Agent's interpretation above.
-        """
-        chef_output = run_agent("Chef Agent", "You are an Indian Home Chef. You hate boring foods and you are creative and innovative and avoid unhealthy foods and dirty bulking, Meals should be meaningful and choose items quantities wisely that they have to reach the Target of {target_cals}kcal for single day(e.g category of avoiding foods: fried foods, junk foods, oil foods, processed foods etc.).", chef_prompt)
-
-        st.write("💰 Planner & Budget Agent: Optimizing Shopping List...")
-        
-        # Build Budget Agent prompt from Request Analysis Agent output
-        budget_cost_guidance = ""
-        if request_analysis["cost_target"]:
-            budget_cost_guidance = f"""
-        
-        ***MANDATORY COST TARGET (from Request Analysis Agent):***
-        - Target Cost: ₹{request_analysis["cost_target"]} total for {duration} days
-        - Daily Budget: ₹{request_analysis["cost_target"]/duration:.2f} per day
-        - This is a STRICT REQUIREMENT - your final ### TOTAL_COST: ### MUST be approximately ₹{request_analysis["cost_target"]}
-        - Acceptable range: ₹{int(request_analysis["cost_target"]-50)} to ₹{int(request_analysis["cost_target"]+50)}
-        - Calculate every ingredient and quantity to match this target
-        - If your calculation doesn't match, REVISE until it does
-        """
-        elif request_analysis["cost_adjustment"] == "decrease" and previous_cost:
-            target_reduction = int(previous_cost * 0.75)
-            budget_cost_guidance = f"""
-        
-        ***COST REDUCTION REQUIRED (from Request Analysis Agent):***
-        - Previous cost: ₹{previous_cost}
-        - Target: Reduce to approximately ₹{target_reduction} or less (20-30% reduction)
-        - Use budget-friendly ingredients: Dal, Eggs, seasonal vegetables, basic staples
-        - Avoid expensive items: Paneer, Chicken, exotic vegetables, premium items
-        - Maintain protein with cheaper alternatives (Dal, Eggs, Soya)
-        """
-        elif request_analysis["cost_adjustment"] == "increase" and previous_cost:
-            target_increase = int(previous_cost * 1.2)
-            budget_cost_guidance = f"""
-        
-        ***COST INCREASE ALLOWED (from Request Analysis Agent):***
-        - Previous cost: ₹{previous_cost}
-        - You can increase to ₹{target_increase} or more
-        - Include premium ingredients, variety, better quality items
-        """
-        elif previous_cost:
-            budget_cost_guidance = f"""
-        
-        ***PREVIOUS PLAN REFERENCE:***
-        - Previous cost: ₹{previous_cost} for {duration} days
-        - Maintain similar cost range unless otherwise specified
-        """
-        
-        budget_items_guidance = ""
-        if request_analysis["items_to_avoid"]:
-            budget_items_guidance += f"""
-        
-        ***ITEMS TO AVOID (from Request Analysis Agent):***
-        - DO NOT include: {", ".join(request_analysis["items_to_avoid"])}
-        - Find nutritionally equivalent, cost-effective alternatives
-        """
-        
-        if request_analysis["items_to_include"]:
-            budget_items_guidance += f"""
-        
-        ***ITEMS TO INCLUDE (from Request Analysis Agent):***
-        - Prioritize: {", ".join(request_analysis["items_to_include"])}
-        """
-        
-        budget_constraints_guidance = ""
-        if request_analysis["constraints"]:
-            budget_constraints_guidance = f"""
-        
-        ***CONSTRAINTS (from Request Analysis Agent):***
-        - Additional constraints: {", ".join(request_analysis["constraints"])}
-        - Respect all constraints while optimizing cost
-        """
-        
-        budget_prompt = f"""
-        Duration: {duration} Days.
-        Menu Concept: {chef_output}
-        
-        {analysis_summary}
-        {budget_cost_guidance}
-        {budget_items_guidance}
-        {budget_constraints_guidance}
-        
-        REALITY CHECK:
-        1. Assume user has Salt, Oil, Turmeric, & Spices.
-        2. Budget for MAIN ingredients: Atta, Rice, Vegetables, Dal, Eggs/Paneer/Chicken, Milk, Curd.
-        3. Market Rates: Eggs ₹7, Milk ₹32/500ml, Chicken ₹280/kg, Paneer ₹100/200g, Veg ₹40-60/kg.
-        (use these items as only reference and not as you only have these items in the market, you can use wide range of items as well, but only healthy and nutritious items)
-        
-        CRITICAL NUTRITION VALIDATION:
-        Before finalizing, VERIFY your plan meets these targets:
-        - Daily Total: {target_cals} kcal (±50 kcal tolerance)
-        - Daily Protein: {tpro}g (±10g tolerance)
-
-        VERIFICATION PROCESS:
-        1. List each meal's calories and protein
-        2. Sum them up for the day
-        3. If UNDER target: Add calorie-dense items (nuts, banana, milk, extra roti)
-        4. If OVER target: Reduce portion sizes slightly
-        5. Output final totals in this EXACT format:
-        #Total: XXXX kcal, XXg protein
-
-        QUANTITY REQUIREMENTS:
-        Every single item MUST have a specific quantity:
-        - ✅ CORRECT: "3 Rotis (330 kcal)", "150g Chicken (250 kcal)", "250ml Milk (150 kcal)"
-        - ❌ WRONG: "Rotis", "Chicken", "Milk"
-
-        ***EXTREMELY IMPORTANT - COST CALCULATION:*** 
-        {f"TARGET COST: ₹{request_analysis['cost_target']} - Your final cost MUST be approximately ₹{request_analysis['cost_target']} (within ₹50 range)" if request_analysis["cost_target"] else "Calculate the total cost accurately based on all ingredients and quantities"}
-        
-        At the very end of your response, output the total cost in this EXACT format:
-        ### TOTAL_COST: 1500 ###
-        (Replace 1500 with your calculated number. Only digits. No other text in this line.)
-        
-        COST CALCULATION PROCESS:
-        1. List ALL ingredients needed for {duration} days
-        2. Calculate quantity needed for each ingredient
-        3. Multiply quantity × market rate for each item
-        4. Sum ALL costs to get total
-        5. {f"VERIFY: Total should be approximately ₹{request_analysis['cost_target']}. If not, adjust quantities and recalculate." if request_analysis["cost_target"] else "Double-check your math"}
-        
-        Task:
-        1. Create a CONSOLIDATED GROCERY LIST for {duration} days.
-        2. Calculate TOTAL ESTIMATED COST based on Request Analysis Agent's interpretation above.
-        3. {f"ENSURE total cost is approximately ₹{request_analysis['cost_target']}" if request_analysis["cost_target"] else "Calculate accurately"}
-        4. Write the Final Meal Plan (Day 1 to {duration}) WITH QUANTITIES.
-        """
-        
-        # Dynamic agent persona - adapts based on Request Analysis Agent output
-        if request_analysis["cost_target"]:
-            agent_persona = f"""You are a PRECISE Budget Manager with a MANDATORY COST TARGET.
-            CRITICAL MISSION: Create a meal plan that costs EXACTLY ₹{request_analysis['cost_target']} total (approximately ₹{request_analysis['cost_target']/duration:.2f} per day).
-            - Your calculated ### TOTAL_COST: ### MUST be close to ₹{request_analysis['cost_target']} (within ₹50 range)
-            - Every ingredient and quantity choice must align with this budget
-            - Calculate carefully: if your cost doesn't match, REVISE your plan
-            - Maintain nutritional balance and target calories of {target_cals} per day within this strict budget
-            - This is NOT a suggestion - it's a REQUIREMENT from the Request Analysis Agent"""
+        chef_prompt = CHEF_PROMPT_TEMPLATE.substitute(
+            cuisine=profile.cuisine, diet=profile.diet_type, allergies=profile.allergies,
+            target_cals=target_cals, tpro=tpro,
+            breakfast_cals=breakfast_cals, breakfast_protein=breakfast_protein,
+            lunch_cals=lunch_cals, lunch_protein=lunch_protein,
+            dinner_cals=dinner_cals, dinner_protein=dinner_protein,
+            snack_cals=snack_cals, snack_protein=snack_protein,
+            meals_per_day=meals_per_day, duration=duration, guidance_block=guidance_block
+        )
+        # Chef and Budget drafts stream into one transient slot under the step log, so the
+        # panel shows progress during the two longest waits; it is cleared before the Manager
+        draft = st.empty()
+        with draft.container():
+            chef_output = st.write_stream(run_agent_stream("Chef Agent", "You are an Indian Home Chef. You hate boring foods and you are creative and innovative and avoid unhealthy foods and dirty bulking, Meals should be meaningful and choose items quantities wisely that they have to reach the Target of {target_cals}kcal for single day(e.g category of avoiding foods: fried foods, junk foods, oil foods, processed foods etc.).", chef_prompt, instructions=CHEF_SYSTEM_PROMPT))
+
+        log_step("💰 Planner & Budget Agent: Optimizing Shopping List...")
+        
+        # Dynamic cost lines and agent persona - adapt to the Request Analysis Agent output
+        cost_target = request_analysis["cost_target"]
+        if cost_target:
+            cost_lines = {k: t.substitute(cost_target=cost_target) for k, t in BUDGET_TARGET_COST_LINES.items()}
+            agent_persona = BUDGET_TARGET_PERSONA_TEMPLATE.substitute(
+                cost_target=cost_target, daily_budget=f"{cost_target / duration:.2f}", target_cals=target_cals
+            )
         else:
-            agent_persona = f"""You are an Intelligent Budget & Nutrition Manager. 
-            Your role is to follow the Request Analysis Agent's interpretation and optimize the meal plan accordingly.
-            - Follow the cost adjustment guidance from Request Analysis Agent
-            - Respect items to avoid/include from Request Analysis Agent
-            - Always maintain nutritional balance and ensure meals reach target calories of {target_cals} per day
-            - Be adaptive based on the Request Analysis Agent's structured output"""
-         
-        plan_text = run_agent(
-            "Planner, while calculating and arranging items be realistc & Budget Agent",
-            agent_persona,
-            budget_prompt
+            cost_lines = BUDGET_OPEN_COST_LINES
+            agent_persona = BUDGET_PERSONA_TEMPLATE.substitute(target_cals=target_cals)
+
+        budget_prompt = BUDGET_PROMPT_TEMPLATE.substitute(
+            duration=duration, chef_output=chef_output, guidance_block=guidance_block,
+            target_cals=target_cals, tpro=tpro, **cost_lines
         )
+         
+        with draft.container():
+            plan_text = st.write_stream(run_agent_stream(
+                "Planner, while calculating and arranging items be realistc & Budget Agent",
+                agent_persona,
+                budget_prompt,
+                instructions=BUDGET_SYSTEM_PROMPT
+            ))
+        draft.empty()
             
         
-        cost_match = re.search(r"###\s*TOTAL_COST:\s*([\d,]+)", plan_text)
-        extracted_cost = cost_match.group(1).replace(",", "") if cost_match else "0"
-        final_cost=extracted_cost
+        # Budget Agent's own total, from its TOTAL_COST marker only: the loose fallbacks would
+        # also hit lines like "Day 1 Total: 1850 kcal" and hide the Manager's budget line
+        final_cost = extract_cost(plan_text, patterns=COST_MARKER_PATTERNS)
     
     
     
-        st.write("🤵 Manager Agent: Formatting...")
-        manager_prompt = f"""
-        Compile this into a user-friendly plan.
-        Doctor Targets: {doc_output}
-        Final Cost: {extracted_cost}
-        Final Plan: {plan_text}
-        
-        FORMAT:
-        1. 🎯 HEALTH TARGETS
-            - Objective: (if {u_data[6]} <= {u_data[7]} then weight gain; else weight lose)
-            - Current weight:{u_data[6]}
-            - Weight goal:{u_data[7]}
-            - Daily required calories for user to reach goal:{target_cals}
-            - Daily required protein for user to reach goal:{tpro}
-        2. 🛍️ SHOPPING LIST
-        3. 📅 DAILY MEAL PLAN
-        4. 📅 DAILY MEAL PLAN (Day 1 to Day {duration})
-            FORMAT FOR EACH DAY:
-            
-            **Day X:**
-            
-            🌅 Breakfast ({breakfast_cals} kcal target):
-            - [Complete meal with quantities]
-            - Estimated: XXX kcal, XXg protein, XXg carbs, XXg fats
-            
-            🌞 Lunch ({lunch_cals} kcal target):
-            - [Complete meal with quantities]
-            - Estimated: XXX kcal, XXg protein, XXg carbs, XXg fats
-            
-            🌙 Dinner ({dinner_cals} kcal target):
-            - [Complete meal with quantities]
-            - Estimated: XXX kcal, XXg protein, XXg carbs, XXg fats
-            
-            🍎 Snacks ({snack_cals} kcal target):
-            - [Healthy snack with quantity]
-            - Estimated: XXX kcal, XXg protein, XXg carbs, XXg fats
-            
-            📊 Day X Total: XXXX kcal, XXg protein, XXg carbs, XXg fats
-            
-            CRITICAL: The sum of all meals should approximately equal:
-            - Target: {target_cals} kcal, {tpro}g protein
-            - Acceptable range: {target_cals - 50} to {target_cals + 50} kcal
-
-        5. 🔢 OVERALL SUMMARY
-            - Total Duration: {duration} days
-            - Average Daily Calories: Should be ~{target_cals} kcal
-            - Average Daily Protein: Should be ~{tpro}g
-                5. 💰 TOTAL COST
-                    (Display a warning about prices are not so accurate it may vary in real world)
-                    IMPORTANT: Include the total cost in this EXACT format at the end:
-                    # Total Budget For Plan: [₹number] 
-                    (e.g., ### Total Budget For Plan: [₹number] ###)
-        6.  FINAL VERDICT (it should be about meal and give message to consult a doctor if needed)
-        """
-        final_output = run_agent("Manager Agent", "You are a Helpful Assistant.", plan_text + "\n\n" + manager_prompt)
+        log_step("🤵 Manager Agent: Formatting...")
+        doc_output = doc_future.result()
+        manager_prompt = MANAGER_PROMPT_TEMPLATE.substitute(
+            weight=profile.weight, goal_weight=profile.goal_weight,
+            target_cals=target_cals, cal_low=target_cals - 50, cal_high=target_cals + 50, tpro=tpro,
+            breakfast_cals=breakfast_cals, lunch_cals=lunch_cals, dinner_cals=dinner_cals, snack_cals=snack_cals,
+            duration=duration, doc_output=doc_output, final_cost=final_cost, plan_text=plan_text
+        )
+        # Stream the longest output so the plan appears as soon as the first tokens arrive
+        final_output = st.write_stream(
+            run_agent_stream("Manager Agent", "You are a Helpful Assistant.", manager_prompt, instructions=MANAGER_SYSTEM_PROMPT)
+        )
         
-        st.write("🔬 Validation Agent: Verifying Nutrition Targets...")
+        log_step("🔬 Validation Agent: Verifying Nutrition Targets...")
         
         extracted_cals = extract_calories(final_output)
         
         # Extract protein (add this helper function)
-        protein_match = re.search(r"(?:Day \d+ Total|#Total).*?(\d+)\s*g\s*protein", final_output, re.IGNORECASE)
+        protein_match = DAY_PROTEIN_RE.search(final_output)
         extracted_protein = int(protein_match.group(1)) if protein_match else 0
         
         cal_gap = target_cals - extracted_cals
@@ -909,7 +1260,7 @@ def generate_plan_workflow(email, age, weight, height, gender, act, goal, durati
                 final_output += f"- {note}\n"
             final_output += "\n💡 *Tip: You can regenerate the plan or manually adjust portion sizes.*"
         
-        st.write(f"{validation_status} Nutrition Validation Complete")
+        log_step(f"{validation_status} Nutrition Validation Complete")
         
         
         # final_output = enforce_minimum_calories(final_output, target_cals, tpro)
@@ -917,35 +1268,10 @@ def generate_plan_workflow(email, age, weight, height, gender, act, goal, durati
         status.update(label="✅ Strategy Finalized!", state="complete", expanded=True)
 
         # --- IMPROVED EXTRACTION LOGIC ---
-        # Search in both plan_output and final_output with multiple patterns
-        extracted_cost = "0"
-
-        # Pattern 1: Exact format with ### markers
-        patterns = [
-            r"###\s*TOTAL_COST:\s*([\d,]+)\s*###",  # With closing ###
-            r"###\s*TOTAL_COST:\s*([\d,]+)",        # Without closing ###
-            r"TOTAL_COST:\s*([\d,]+)",              # Without ### markers
-            r"Total Cost[:\s]+₹?\s*([\d,]+)",       # Natural language format
-            r"Total[:\s]+₹?\s*([\d,]+)",            # Just "Total:"
-            r"₹\s*([\d,]+)",                         # Just currency symbol
-        ]
-
-        # Search in final_output first (most likely location after formatting)
-        for pattern in patterns:
-            cost_match = re.search(pattern, final_output, re.IGNORECASE)
-            if cost_match:
-                extracted_cost = cost_match.group(1).replace(",", "").strip()
-                if extracted_cost and extracted_cost.isdigit():
-                    break
-
-        # Fallback: search in plan_output if not found in final_output
-        if extracted_cost == "0":
-            for pattern in patterns:
-                cost_match = re.search(pattern, plan_text, re.IGNORECASE)
-                if cost_match:
-                    extracted_cost = cost_match.group(1).replace(",", "").strip()
-                    if extracted_cost and extracted_cost.isdigit():
-                        break
+        # The Manager only copies the Budget Agent's TOTAL_COST, so that marker is the
+        # source of truth; the formatted plan (whose first ₹ may be an item price) is
+        # scanned only when the Budget Agent left no total
+        extracted_cost = final_cost if final_cost != "0" else extract_cost(final_output)
 
         st.session_state['current_strategy'] = final_output
         st.session_state['total_budget'] = extracted_cost
@@ -957,12 +1283,33 @@ def generate_plan_workflow(email, age, weight, height, gender, act, goal, durati
         })
         st.session_state["agent_memory"]["global"]["approved_plans"].append(final_output)
 
-    return final_output, final_cost
+    return final_output, extracted_cost
+
+def plan_excerpt(plan_text, limit):
+    # """First `limit` chars of a plan, cut back to a line break so prompts never end mid-item"""
+    if len(plan_text) <= limit:
+        return plan_text
+    cut = plan_text.rfind("\n", 0, limit)
+    return plan_text[:cut if cut > 0 else limit] + "..."
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def plan_summary(plan_text, limit):
+    # """Headline numbers + excerpt of a plan for the chat context; built once per plan text, not per chat turn"""
+    headline = []
+    calories, protein, cost = extract_calories(plan_text), extract_protein(plan_text), extract_cost(plan_text, patterns=COST_LABELLED_PATTERNS)
+    if calories:
+        headline.append(f"Calories/day: {calories} kcal")
+    if protein:
+        headline.append(f"Protein/day: {protein} g")
+    if cost != "0":
+        headline.append(f"Total cost: ₹{cost}")
+    summary = plan_excerpt(plan_text, limit)
+    return f"{' | '.join(headline)}\n{summary}" if headline else summary
 
 def refine_plan_with_feedback(current_plan, feedback_msg):
     prompt = f"""
     The user REJECTED the previous plan.
-    Previous Plan Summary: {current_plan[:1000]}...
+    Previous Plan Summary: {plan_excerpt(current_plan, 1000)}
 
     User Feedback: "{feedback_msg}"
 
@@ -990,67 +1337,285 @@ def build_chat_memory_context():
     return context
 
 
-def live_chat_reply(history, user_context):
-    system_msg = (
-        "You are a friendly, detailed nutrition assistant. "
-        f"Context on User: {user_context} "
-        "Your responses must be fully complete. "
-        "Write at least 5-8 sentences with explanations and guidance. "
-        "If food diary entries conflict with the planned diet, politely point it out and suggest corrections."
-        "If the user asks about their plan, refer to the 'Approved Plan' context provided."
-    )
+def record_cache_usage(usage):
+    # """Accumulates prompt vs. server-cached prompt tokens for this session"""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    stats = st.session_state.setdefault("cache_stats", {"prompt_tokens": 0, "cached_tokens": 0})
+    stats["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+    stats["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+def chat_cache_key(user_context, recent_history):
+    # Same context + same earlier turns + same question modulo case, punctuation and spacing -> same key;
+    # the earlier turns are the ones the model is sent, so "why?" after a different answer misses
+    *earlier, last = recent_history
+    question = CHAT_NORMALIZE_RE.sub(" ", last["content"].lower()).strip()
+    turns = "\x00".join(f"{m['role']}:{m['content']}" for m in earlier)
+    return hashlib.sha256(f"{user_context}\x00{turns}\x00{question}".encode()).hexdigest()
+
+CHAT_SYSTEM_PROMPT = (
+    "You are a friendly, detailed nutrition assistant. "
+    "Your responses must be fully complete. "
+    "Write at least 5-8 sentences with explanations and guidance. "
+    "If food diary entries conflict with the planned diet, politely point it out and suggest corrections."
+    "If the user asks about their plan, refer to the 'Approved Plan' context provided."
+)
+
+# Per-turn user context for the chat assistant; parsed once here, filled by substitute() each question
+CHAT_CONTEXT_TEMPLATE = string.Template("""
+USER PROFILE:
+Age: $age
+Weight: $weight kg → Goal: $goal_weight kg
+Diet: $diet, Cuisine: $cuisine
+
+PRIMARY CONTEXT (ACTIVE TAB: $active_tab):
+$tab_memory
+
+SECONDARY CONTEXT (GLOBAL MEMORY):
+$global_memory
 
-    recent_history = history[-4:]
+PLAN CONTEXT:
+$plan_context
 
-    # Convert session history to Groq format
-    messages = [{"role":"system", "content": system_msg}] + recent_history
+LEGACY CONTEXT (COMPATIBILITY):
+Meal Plan:
+$meal_plan
 
-    resp = get_groq_client().chat.completions.create(
+Budget:
+₹$total_budget
+
+Carbon Analysis:
+CO₂: $co2
+Score: $score
+
+Food Diary:
+$recent_food_log
+""")
+
+def live_chat_reply(history, user_context, user_id=None):
+    """
+    Yields the assistant reply chunk by chunk, for st.write_stream.
+    Repeat questions against an unchanged context and the same earlier turns
+    reuse this session's earlier reply, yielded as a single chunk.
+    """
+    # Walk the deque from the right end, so only the last four turns are touched, not the whole history
+    recent_history = list(islice(reversed(history), 4))[::-1]
+
+    chat_cache = st.session_state.setdefault("chat_cache", {})
+    key = chat_cache_key(user_context, recent_history) if recent_history else None
+    if key in chat_cache:
+        yield chat_cache[key]
+        return
+
+    # Convert session history to Groq format; the fixed instructions lead so every
+    # call shares the same prompt prefix, and the changing user context follows
+    messages = [
+        {"role": "system", "content": CHAT_SYSTEM_PROMPT},
+        {"role": "system", "content": f"Context on User: {user_context}"}
+    ] + recent_history
+
+    params = {"user": hashlib.sha256(user_id.encode()).hexdigest()[:16]} if user_id else {}
+    throttle_groq()
+    stream = groq_client.chat.completions.create(
         model="llama-3.1-8b-instant",
         messages=messages,
         max_tokens=800,
-        temperature=0.7
+        temperature=0.7,
+        stream=True,
+        **params
     )
-    return resp.choices[0].message.content
+    parts = []
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
+        # Groq reports usage on the final chunk under x_groq
+        record_cache_usage(getattr(getattr(chunk, "x_groq", None), "usage", None))
+    if key:
+        if len(chat_cache) >= CHAT_CACHE_MAX_ENTRIES:
+            chat_cache.pop(next(iter(chat_cache)))   # dicts keep insertion order: drop the oldest reply
+        chat_cache[key] = "".join(parts)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def prep_meal_image(raw_bytes):
+    # """Decodes an upload once, downsizes it and re-encodes as JPEG for display and Gemini"""
+    # Apply the EXIF orientation first: the re-encode drops the tag, and portrait phone shots would come out sideways
+    img = ImageOps.exif_transpose(Image.open(BytesIO(raw_bytes)))
+    img.thumbnail((MEAL_IMAGE_MAX_SIDE, MEAL_IMAGE_MAX_SIDE), Image.LANCZOS)
+    buf = BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+MEAL_IMAGE_PROMPT = "Identify this food in an Indian context. Estimate calories and macros."
 
 def analyze_image(uploaded_file):
-    img = Image.open(uploaded_file)
+    # Same prepared image -> same analysis; served from llm_cache keyed by the digest of the JPEG
+    # Gemini is sent, so the same photo re-encoded by another client still hits the cache
+    prepared = prep_meal_image(uploaded_file.getvalue())
+    key = llm_cache_key("gemini-2.5-flash", None, [MEAL_IMAGE_PROMPT, hashlib.sha256(prepared).hexdigest()], {})
+    cached = get_cached_reply(key)
+    if cached is not None:
+        return cached
+
+    img = Image.open(BytesIO(prepared))
     response = genai_client.models.generate_content(
         model="gemini-2.5-flash",
-        contents=["Identify this food in an Indian context. Estimate calories and macros.", img]
+        contents=[MEAL_IMAGE_PROMPT, img],
+        # The user is waiting on a spinner; skip 2.5 Flash's thinking phase for a faster first token
+        config={"thinking_config": {"thinking_budget": 0}}
     )
+    if response.text:
+        store_cached_reply(key, response.text)
     return response.text
 
+# (keywords, kg CO2e per meal), highest-impact first; the first tier with any hit wins
+CARBON_TIERS = (
+    (("mutton", "lamb", "beef"), 2.5),   # very high impact per meal
+    (("chicken",), 0.8),
+    (("paneer", "cheese", "butter"), 0.6),
+    (("egg",), 0.4),
+    (("fish",), 0.5),
+    (("dal", "lentil", "beans"), 0.2),
+    (("vegetable", "sabzi", "salad"), 0.15),
+    (("rice", "roti", "chapati"), 0.25),
+)
+CARBON_KEYWORD_TIER = {kw: tier for tier, (keywords, _) in enumerate(CARBON_TIERS) for kw in keywords}
+CARBON_RE = re.compile("|".join(map(re.escape, CARBON_KEYWORD_TIER)))
+CARBON_DEFAULT_KG = 0.35   # unknown mixed meal
+
 def estimate_food_carbon(food_text):
     """
     Rough per-meal CO2e estimator (kg CO2e)
     Based on global LCA averages.
     """
 
-    text = food_text.lower()
-
-    if any(x in text for x in ["mutton", "lamb", "beef"]):
-        return 2.5   # very high impact per meal
-    if any(x in text for x in ["chicken"]):
-        return 0.8
-    if any(x in text for x in ["paneer", "cheese", "butter"]):
-        return 0.6
-    if any(x in text for x in ["egg"]):
-        return 0.4
-    if any(x in text for x in ["fish"]):
-        return 0.5
-    if any(x in text for x in ["dal", "lentil", "beans"]):
-        return 0.2
-    if any(x in text for x in ["vegetable", "sabzi", "salad"]):
-        return 0.15
-    if any(x in text for x in ["rice", "roti", "chapati"]):
-        return 0.25
-
-    # default unknown mixed meal
-    return 0.35
+    # One scan for every keyword, then keep the highest-impact tier that appeared
+    tiers = [CARBON_KEYWORD_TIER[kw] for kw in CARBON_RE.findall(food_text.lower())]
+    if tiers:
+        return CARBON_TIERS[min(tiers)][1]
+
+    return CARBON_DEFAULT_KG
+
+ECO_ANALYSIS_MODES = ("Planned Meal (Strategy)", "Actual Meals (Photos)")
+ECO_ANALYSIS_LABELS = dict(zip(ECO_ANALYSIS_MODES, ("PLANNED MEAL STRATEGY", "ACTUAL CONSUMED MEALS")))
+ECO_PREFETCH_IN_FLIGHT = 1   # unfinished speculative eco reports per session; each takes a slot in the Groq rate window
+
+# Diaries whose every recent meal is at or below this (the grain, pulse and vegetable tiers)
+# are reported locally, without the Environmental Analyst
+LOW_IMPACT_MEAL_CO2_KG = 0.25
+LOW_IMPACT_SCORE = 95
+LOW_IMPACT_ECO_REPORT = (
+    "Your recent meals are all low-impact foods (grains, pulses and vegetables). "
+    "Their combined footprint is well under a typical day's food emissions, so keep it up — "
+    "favouring plant proteins over meat and dairy is the biggest lever you have."
+)
+
+# Static task and format spec; sent ahead of the food data so every eco call shares the same prompt prefix
+ECO_SYSTEM_PROMPT = """
+You are an Environmental Scientist.
+
+TASKS:
+1. Estimate total carbon footprint (kg CO2e) of the food data you are given
+2. Assign a sustainability score (0–100)
+
+OUTPUT FORMAT (STRICT):
+Reply with one JSON object and nothing else:
+{"co2": <number, kg CO2e>, "score": <integer 0-100>, "explanation": "<short explanation>"}
+"""
+# Groq JSON mode: the reply is always a parseable object (JSON mode replies are not streamed)
+ECO_RESPONSE_FORMAT = {"type": "json_object"}
+
+# One fixed data header per analysis source, resolved here instead of formatted on every call
+ECO_DATA_HEADERS = {
+    mode: f"Analyze the following food data ({label}):\n" for mode, label in ECO_ANALYSIS_LABELS.items()
+}
+
+def eco_agent_call(analysis_mode, analysis_context):
+    # """(role, persona, prompt, instructions) for the Environmental Analyst on a plan/diary snapshot"""
+    eco_prompt = ECO_DATA_HEADERS[analysis_mode] + analysis_context
+    return "Environmental Analyst", "You are a precise environmental scientist.", eco_prompt, ECO_SYSTEM_PROMPT
+
+def build_eco_report(analysis_mode, analysis_context):
+    # Blocking call; also what the agent executor runs for prefetches
+    call = eco_agent_call(analysis_mode, analysis_context)
+    try:
+        return run_agent(*call, response_format=ECO_RESPONSE_FORMAT)
+    except BadRequestError:
+        # Groq answers 400 json_validate_failed when the model's JSON is malformed; ask again
+        # without JSON mode and let parse_eco_report find the object or fall back to defaults
+        return run_agent(*call)
+
+def eco_llm_context(analysis_mode, email):
+    # """Prompt context the Environmental Analyst would get for a tab3 source; None if it has no data or is scored locally"""
+    if analysis_mode == ECO_ANALYSIS_MODES[0]:
+        return st.session_state.get('current_strategy')
+    if get_low_impact_co2_total(email) is not None:
+        return None
+    return get_food_log_context(email) or None
+
+def mark_eco_tab_used():
+    # on_change/on_click callback for the Eco tab widgets: the run it triggers starts with the user on tab3
+    st.session_state["eco_tab_used"] = True
+
+def prefetch_eco_report(prefetches, analysis_mode, analysis_context):
+    # Submits the report for a snapshot to the agent executor while fewer than ECO_PREFETCH_IN_FLIGHT are still running
+    fingerprint = hash((analysis_mode, analysis_context))
+    in_flight = sum(not future.done() for future in prefetches.values())
+    if fingerprint not in prefetches and in_flight < ECO_PREFETCH_IN_FLIGHT:
+        prefetches[fingerprint] = get_agent_executor().submit(build_eco_report, analysis_mode, analysis_context)
+        while len(prefetches) > len(ECO_ANALYSIS_MODES):   # finished reports kept: at most one per source
+            prefetches.pop(next(iter(prefetches))).cancel()
+
+class EcoMetrics(NamedTuple):
+    # Display-ready dashboard values, formatted once when a report comes in
+    co2_text: str
+    car_text: str
+    trees_text: str
+    score: int   # 0-100, passed to st.progress as-is
+
+def build_eco_metrics(co2, score):
+    return EcoMetrics(
+        co2_text=f"{co2:.2f} kg CO₂e",
+        car_text=f"{co2 * 4:.1f} km",
+        trees_text=f"{co2 / 20:.1f} trees/year",
+        score=max(0, min(100, int(score))),
+    )
+
+def parse_eco_report(eco_report):
+    """
+    Splits an Environmental Analyst reply into (co2, score, explanation).
+    The reply is a JSON-mode {"co2", "score", "explanation"} object; older cached
+    replies lead with a bare {"co2", "score"} line or use '### CO2: N ###' /
+    '### SCORE: N ###' marker lines, matched together when adjacent and separately otherwise.
+    Missing values default to 0.0 kg and a score of 50.
+    """
+    found = find_json_object(eco_report, "co2")
+    if found:
+        metrics, start, end = found
+        try:
+            explanation = metrics.get("explanation") or (eco_report[:start] + eco_report[end:])
+            return float(metrics["co2"]), int(metrics.get("score", 50)), str(explanation).strip()
+        except (TypeError, ValueError):
+            pass # Malformed values; fall back to the marker lines
+
+    report_match = ECO_REPORT_RE.search(eco_report)
+    if report_match:
+        clean_report = eco_report[:report_match.start()] + eco_report[report_match.end():]
+        return float(report_match.group(1)), int(report_match.group(2)), clean_report.strip()
+
+    co2_match = ECO_CO2_RE.search(eco_report)
+    score_match = ECO_SCORE_RE.search(eco_report)
+
+    est_co2 = float(co2_match.group(1)) if co2_match else 0.0
+    sust_score = int(score_match.group(1)) if score_match else 50
+
+    return est_co2, sust_score, ECO_MARKER_RE.sub("", eco_report).strip()
 
 # --- 4. CSS ---
-st.markdown("""
+# Module-level constant: Streamlit still needs the markdown call each rerun, but the string isn't rebuilt
+APP_CSS = """
 <style>
     div[data-testid="stDialog"] {
         backdrop-filter: blur(10px) !important;
@@ -1063,8 +1628,26 @@ st.markdown("""
     padding-right: 10px;
     }
 
+    .chat-scroll .msg {
+    margin: 6px 0;
+    padding: 8px 12px;
+    border-radius: 10px;
+    white-space: pre-wrap;
+    }
+
+    .chat-scroll .msg.user {
+    background-color: rgba(100, 149, 237, 0.15);
+    margin-left: 15%;
+    }
+
+    .chat-scroll .msg.assistant {
+    background-color: rgba(128, 128, 128, 0.12);
+    margin-right: 15%;
+    }
+
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # --- 5. UI FLOW ---
 if (
@@ -1077,11 +1660,15 @@ if (
         st.session_state['logged_in'] = True
         st.session_state['user_info'] = user
 
-if 'logged_in' not in st.session_state: st.session_state['logged_in'] = False
-if 'user_info' not in st.session_state: st.session_state['user_info'] = None
-if 'pending_plan' not in st.session_state: st.session_state['pending_plan'] = None
-if 'feedback_mode' not in st.session_state: st.session_state['feedback_mode'] = False
-if 'live_chat' not in st.session_state: st.session_state['live_chat'] = []
+SESSION_DEFAULTS = {
+    'logged_in': False,
+    'user_info': None,
+    'pending_plan': None,
+    'feedback_mode': False,
+    'live_chat': deque(maxlen=LIVE_CHAT_MAX_MESSAGES),
+}
+for key, default in SESSION_DEFAULTS.items():
+    st.session_state.setdefault(key, default)
 
 # --- GLOBAL AGENT MEMORY ---
 if "agent_memory" not in st.session_state:
@@ -1101,7 +1688,7 @@ if "agent_memory" not in st.session_state:
                 "last_feedback": None
             },
             "tab2": {   # Visual Tracker
-                "food_diary": [],
+                "food_diary": deque(maxlen=FOOD_DIARY_MAX_ENTRIES),
                 "last_image_analysis": None
             },
             "tab3": {   # Carbon Footprint
@@ -1115,6 +1702,47 @@ if "agent_memory" not in st.session_state:
 final_cost=0
 cdays=0
 
+def render_eco_dashboard(metrics, source, summary, report):
+    # """Impact Dashboard for the last carbon analysis, drawn from the metrics stored in tab3 memory"""
+    st.subheader(f"📊 Impact Dashboard — {source}")
+
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Est. Carbon Emissions", metrics.co2_text)
+    m2.metric("Equivalent Car Travel", metrics.car_text)
+    m3.metric("Trees Needed to Offset", metrics.trees_text)
+
+    st.progress(metrics.score)
+    st.caption(f"Sustainability Score: {metrics.score}/100")
+
+    if summary:
+        st.success(f"**Summary:** {summary}")
+
+    if report:
+        with st.expander("📝 Scientist’s Explanation", expanded=True):
+            st.write(report)
+
+def render_cost_metrics(total_budget, duration):
+    # """Financial Forecast card: total plan cost and the per-day average"""
+    with st.container(border=True):
+        st.markdown("### 💰 Financial Forecast")
+
+        left, spacer, right = st.columns([2, 1, 2])
+
+        try:
+            budget_clean = strip_cost(str(total_budget))
+            total_cost = float(budget_clean) if budget_clean else 0.0
+
+            if total_cost > 0:
+                left.metric("Total Cost", f"₹{total_cost:,.0f}")
+                right.metric("Daily Average", f"₹{total_cost / duration:,.0f} / day")
+            else:
+                left.metric("Total Cost", "₹--")
+                right.metric("Daily Average", "₹--")
+
+        except Exception:
+            left.metric("Total Cost", "₹--")
+            right.metric("Daily Average", "₹--")
+
 # ================= POP-UP LOGIN LOGIC =================
 
 @st.dialog("🔐 Login / Sign Up")
@@ -1148,18 +1776,18 @@ def login_dialog():
             new_pass = st.text_input("Password", type='password', key="signup_pass")
             new_user = st.text_input("Display Name", key="signup_name")
             new_age = st.number_input("Age", 15, 90, 25, key="signup_age")
-            new_gender = st.selectbox("Gender", ["Male", "Female", "Other"], key="signup_gen")
+            new_gender = st.selectbox("Gender", GENDERS, key="signup_gen")
             new_allergy = st.text_input("Allergies", key="signup_allergy")
         
         with col2:
             new_height = st.number_input("Height (cm)", 100, 250, 170, key="signup_ht")
             new_weight = st.number_input("Weight (kg)", 30, 150, 70, key="signup_wt")
             new_goal_w = st.number_input("Goal Wt (kg)", 30, 150, 65, key="signup_gw")
-            new_activity = st.selectbox("Activity", ["Sedentary", "Active", "Very Active"], key="signup_act")
+            new_activity = st.selectbox("Activity", ACTIVITY_LEVELS, key="signup_act")
             new_cuisine = st.text_input("Cuisine Pref", value="Indian", key="signup_cuisine")
         
         new_meals = st.slider("Meals/Day", 2, 6, 3, key="signup_meals")
-        new_diet = st.selectbox("Diet Type", ["Vegetarian", "Non-Vegetarian", "Vegan"], key="signup_diet")
+        new_diet = st.selectbox("Diet Type", DIET_TYPES, key="signup_diet")
         new_sleep = st.slider("Sleep (Hrs)", 4.0, 12.0, 7.0, key="signup_sleep")
 
         if st.button("Sign Up", use_container_width=True):
@@ -1185,32 +1813,35 @@ if not st.session_state['logged_in']:
 
 else:
     u_data = st.session_state['user_info']
-    st.sidebar.title(f"👤 {u_data[1]}")
-    st.sidebar.caption(f"ID: {u_data[0]}")
+    st.sidebar.title(f"👤 {u_data.username}")
+    st.sidebar.caption(f"ID: {u_data.email}")
+    # Totals recorded by record_cache_usage for this session's chat replies so far
+    cache_stats = st.session_state.get("cache_stats")
+    if cache_stats and cache_stats["prompt_tokens"]:
+        st.sidebar.caption(
+            f"⚡ Chat prompt cache: {cache_stats['cached_tokens']:,} of {cache_stats['prompt_tokens']:,} prompt tokens reused"
+        )
     
     with st.sidebar.expander("📝 Edit Profile"):
-        e_age = st.number_input("Age", value=u_data[3], key="edit_age")
-        e_weight = st.number_input("Weight", value=u_data[6], key="edit_weight")
-        e_goal = st.number_input("Goal Weight", value=u_data[7], key="edit_goal")
+        e_age = st.number_input("Age", value=u_data.age, key="edit_age")
+        e_weight = st.number_input("Weight", value=u_data.weight, key="edit_weight")
+        e_goal = st.number_input("Goal Weight", value=u_data.goal_weight, key="edit_goal")
         
-        e_activity_list = ["Sedentary", "Active", "Very Active"]
-        curr_act = u_data[8] if u_data[8] in e_activity_list else "Sedentary"
-        e_activity = st.selectbox("Activity", e_activity_list, index=e_activity_list.index(curr_act), key="edit_act")
+        # Unknown stored values fall back to the first option (Sedentary / Vegetarian)
+        e_activity = st.selectbox("Activity", ACTIVITY_LEVELS, index=ACTIVITY_INDEX.get(u_data.activity, 0), key="edit_act")
         
-        e_diet_list = ["Vegetarian", "Non-Vegetarian", "Vegan"]
-        curr_diet = u_data[10] if u_data[10] in e_diet_list else "Vegetarian"
-        e_diet = st.selectbox("Diet Type", e_diet_list, index=e_diet_list.index(curr_diet), key="edit_diet")
+        e_diet = st.selectbox("Diet Type", DIET_TYPES, index=DIET_INDEX.get(u_data.diet_type, 0), key="edit_diet")
         
-        e_allergy = st.text_input("Allergies", value=u_data[12], key="edit_allergy")
-        e_cuisine = st.text_input("Cuisine", value=u_data[13], key="edit_cuisine")
+        e_allergy = st.text_input("Allergies", value=u_data.allergies, key="edit_allergy")
+        e_cuisine = st.text_input("Cuisine", value=u_data.cuisine, key="edit_cuisine")
 
         if st.button("Update Profile"):
-            update_user_profile(u_data[0], e_age, u_data[4], u_data[5], e_weight, e_goal, e_activity, u_data[9], e_diet, u_data[11], e_allergy, e_cuisine)
-            st.session_state['user_info'] = get_user_by_email(u_data[0]) 
+            update_user_profile(u_data.email, e_age, u_data.gender, u_data.height, e_weight, e_goal, e_activity, u_data.meals_per_day, e_diet, u_data.sleep, e_allergy, e_cuisine)
+            st.session_state['user_info'] = get_user_by_email(u_data.email) 
             st.success("Updated!")
 
         with st.sidebar.expander("📚 Your Diet History"):
-            approved = get_approved_plans(u_data[0])
+            approved = get_approved_plans(u_data.email)
             if not approved: st.caption("No plans yet.")
             for i, (ts, plan) in enumerate(approved, 1):
                 if st.button(f"📅 Plan {ts[:10]}", key=f"hist_{i}"):
@@ -1226,7 +1857,7 @@ else:
         
     with st.sidebar.expander("⚠️ Danger Zone"):
         if st.button("Delete My Account", type="primary"):
-            delete_user_account(u_data[0])
+            delete_user_account(u_data.email)
             st.session_state.clear()
             st.success("Account Deleted.")
             st.rerun()
@@ -1271,12 +1902,11 @@ else:
         if st.button("Forecast Plan", disabled=is_locked):
             
             # 1. Determine Goal
-            obj = "Weight Loss" if u_data[6] > u_data[7] else "Muscle Gain"
+            obj = plan_objective(u_data)
 
             # 2. Run Workflow (NO DISPLAYING TEXT HERE)
             final_plan, cost = generate_plan_workflow(
-                u_data[0], u_data[3], u_data[6], u_data[5], u_data[4], u_data[8], 
-                obj, cdays, u_data[13], u_data[10], u_data[12], u_data[9]
+                u_data, obj, cdays, u_data.meals_per_day
             )
 
             # 3. STRICT REPLACEMENT: Overwrite any existing pending plan
@@ -1299,34 +1929,7 @@ else:
             # This is the ONLY place the plan text is printed to the screen
             st.info(st.session_state['pending_plan'])
             
-            with st.container(border=True):
-                st.markdown("### 💰 Financial Forecast")
-
-                left, spacer, right = st.columns([2, 1, 2])
-
-                try:
-                    budget_str = str(st.session_state.get("total_budget", "0"))
-                    budget_clean = re.sub(r"[^\d.]", "", budget_str)
-                    total_cost = float(budget_clean) if budget_clean else 0.0
-                    duration = st.session_state.get("plan_duration", 1)
-
-                    if total_cost > 0:
-                        left.metric(
-                            "Total Cost",
-                            f"₹{total_cost:,.0f}"
-                        )
-
-                        right.metric(
-                            "Daily Average",
-                            f"₹{total_cost / duration:,.0f} / day"
-                        )
-                    else:
-                        left.metric("Total Cost", "₹--")
-                        right.metric("Daily Average", "₹--")
-
-                except Exception:
-                    left.metric("Total Cost", "₹--")
-                    right.metric("Daily Average", "₹--")
+            render_cost_metrics(st.session_state.get("total_budget", "0"), st.session_state.get("plan_duration", 1))
             
             # ACTION BUTTONS (Only if not in feedback mode)
             if not st.session_state['feedback_mode']:
@@ -1334,9 +1937,7 @@ else:
                 with b1:
                     # APPROVE: Store in DB
                     if st.button("👍 Approve & Save Plan", type="primary", use_container_width=True):
-                        save_diet_plan(u_data[0], st.session_state['pending_plan'], "approved")
-                        get_latest_approved_context.clear() # Refresh Chat Context
-                        st.success("✅ Plan Saved to History!")
+                        save_diet_plan(u_data.email, st.session_state['pending_plan'], "approved") # Also refreshes chat context
                         st.session_state['pending_plan'] = None # Remove from Pending view
                         st.success("✅ Plan Saved to History!")
 
@@ -1352,397 +1953,249 @@ else:
                         st.success("You can now provide feedback below to refine the plan.")
 
     # --- INTELLIGENT CHAT SYSTEM ---
+    # Runs as a fragment: chat-only turns rerun just this panel, plan changes still rerun the app
+    @st.fragment
+    def chat_panel():
+        # The panel renders right after the Strategic Planner tab, which is the active
+        # tab it sees on a full run; keep that on fragment-only reruns
+        st.session_state["active_tab"] = "tab1"
     
-    if st.session_state['feedback_mode']:
-        st.warning("📝 Feedback Mode: Why did you reject the plan?")
-        feedback_msg = st.chat_input("Ex: 'I don't like Tofu', 'Too expensive'...")
-        if feedback_msg:
-            stored_duration = st.session_state.get("plan_duration", 7)
-
-        # Previous cost (for relative adjustment)
-            prev_cost_raw = st.session_state.get("total_budget", "0")
-            try:
-                prev_cost_clean = re.sub(r"[^\d.]", "", str(prev_cost_raw))
-                previous_cost = float(prev_cost_clean) if prev_cost_clean else None
-            except:
-                previous_cost = None
-
-            # --- REGENERATE PLAN ---
-            with st.status("🔄 Regenerating plan based on your feedback...", expanded=True):
-                obj = "Weight Loss" if u_data[6] > u_data[7] else "Muscle Gain"
-
-                final_plan, cost = generate_plan_workflow(
-                    u_data[0], u_data[3], u_data[6], u_data[5], u_data[4], u_data[8],
-                    obj,
-                    stored_duration,
-                    u_data[13],
-                    u_data[10],
-                    u_data[12],
-                    u_data[9],
-                    feedback=feedback_msg,
-                    previous_cost=previous_cost
-                )
-                
-            with st.container(border=True):
-                st.markdown("### 💰 Financial Forecast")
-
-                left, spacer, right = st.columns([2, 1, 2])
-
+        if st.session_state['feedback_mode']:
+            st.warning("📝 Feedback Mode: Why did you reject the plan?")
+            feedback_msg = st.chat_input("Ex: 'I don't like Tofu', 'Too expensive'...")
+            if feedback_msg:
+                stored_duration = st.session_state.get("plan_duration", 7)
+
+            # Previous cost (for relative adjustment)
+                prev_cost_raw = st.session_state.get("total_budget", "0")
                 try:
-                    budget_str = str(st.session_state.get("total_budget", "0"))
-                    budget_clean = re.sub(r"[^\d.]", "", budget_str)
-                    total_cost = float(budget_clean) if budget_clean else 0.0
-                    duration = st.session_state.get("plan_duration", 1)
-
-                    if total_cost > 0:
-                        left.metric(
-                            "Total Cost",
-                            f"₹{total_cost:,.0f}"
-                        )
-
-                        right.metric(
-                            "Daily Average",
-                            f"₹{total_cost / duration:,.0f} / day"
-                        )
-                    else:
-                        left.metric("Total Cost", "₹--")
-                        right.metric("Daily Average", "₹--")
-
-                except Exception:
-                    left.metric("Total Cost", "₹--")
-                    right.metric("Daily Average", "₹--")
+                    prev_cost_clean = strip_cost(str(prev_cost_raw))
+                    previous_cost = float(prev_cost_clean) if prev_cost_clean else None
+                except:
+                    previous_cost = None
 
-            # --- UPDATE STATE ---
-            st.session_state['pending_plan'] = final_plan
-            st.session_state['total_budget'] = cost
-            st.session_state['feedback_mode'] = False
+                # --- REGENERATE PLAN ---
+                with st.status("🔄 Regenerating plan based on your feedback...", expanded=True):
+                    obj = plan_objective(u_data)
 
-            st.success("✅ Plan regenerated based on your feedback.")
-            st.rerun()
+                    final_plan, cost = generate_plan_workflow(
+                        u_data, obj, stored_duration, u_data.meals_per_day,
+                        feedback=feedback_msg,
+                        previous_cost=previous_cost
+                    )
 
-    else:
-        # Display Chat History
-        if st.session_state['live_chat']:
-            with st.expander("💬 Chat History", expanded=True):
-                st.markdown('<div class="chat-scroll">', unsafe_allow_html=True)
+                # --- UPDATE STATE ---
+                st.session_state['pending_plan'] = final_plan
+                st.session_state['total_budget'] = cost
+                st.session_state['feedback_mode'] = False
 
-                for msg in st.session_state['live_chat']:
-                    with st.chat_message(msg["role"]):
-                        st.write(msg["content"])
+                # The rerun redraws the pending plan and its cost metrics
+                st.rerun()
 
-                st.markdown('</div>', unsafe_allow_html=True)
+        else:
+            # Display Chat History
+            if st.session_state['live_chat']:
+                with st.expander("💬 Chat History", expanded=True):
+                    # One HTML block for the whole history instead of a chat_message element per turn;
+                    # newlines become <br> because a blank line would end the HTML block and hand the rest to Markdown
+                    chat_html = "".join(
+                        f'<div class="msg {msg["role"]}">{"🧑" if msg["role"] == "user" else "🤖"} {html.escape(msg["content"]).replace(chr(10), "<br>")}</div>'
+                        for msg in st.session_state['live_chat']
+                    )
+                    st.markdown(f'<div class="chat-scroll">{chat_html}</div>', unsafe_allow_html=True)
 
-        # --- THE SMART INPUT ---
-        user_msg = st.chat_input("Ask a question OR type 'Make me a diet plan'...")
+            # --- THE SMART INPUT ---
+            user_msg = st.chat_input("Ask a question OR type 'Make me a diet plan'...")
         
-        if user_msg:
-            # 1. Add User Message to UI
-            st.session_state['live_chat'].append({"role": "user", "content": user_msg})
-            
-            # 2. AI-POWERED INTENT DETECTION
-            has_pending_plan = st.session_state.get('pending_plan') is not None
-            intent_data = detect_user_intent(user_msg, st.session_state['live_chat'], has_pending_plan)
+            # Whitespace-only submissions skip intent detection, the context build and the LLM call
+            if user_msg and user_msg.strip():
+                # 1. Add User Message to UI
+                st.session_state['live_chat'].append({"role": "user", "content": user_msg})
             
-            intent = intent_data.get("intent", "GENERAL_QUESTION")
-            duration = intent_data.get("duration")
-            req_meals = intent_data.get("meals_per_day") or u_data[9]
-            feedback_text = intent_data.get("feedback")
+                # 2. AI-POWERED INTENT DETECTION
+                has_pending_plan = st.session_state.get('pending_plan') is not None
+                intent_data = detect_user_intent(user_msg, st.session_state['live_chat'], has_pending_plan)
             
-            # 3. DYNAMIC ROUTING BASED ON DETECTED INTENT
-            if intent == "CREATE_PLAN":
-                # User wants to create a new plan
-                if duration:
-                    if duration > 7:
-                        st.session_state['live_chat'].append({"role": "assistant", "content": "⚠️ Limit is 7 days. Generating a 7-day plan..."})
-                        duration = 7
-                    if duration < 1:
-                        duration = 1
-
-                    # Generate new plan
-                    with st.status(f"👨‍🍳 Designing {req_meals}-Meal Strategy for {duration} Days...", expanded=True) as status:
-                        obj = "Weight Loss" if u_data[6] > u_data[7] else "Muscle Gain"
-                        final_plan, cost = generate_plan_workflow(
-                            u_data[0], u_data[3], u_data[6], u_data[5], u_data[4], u_data[8], 
-                            obj, duration, u_data[13], u_data[10], u_data[12], req_meals
-                        )
-                    status.update(label="✅ Strategy Ready!", state="complete", expanded=False)
-                    
-                    with st.container(border=True):
-                        st.markdown("### 💰 Financial Forecast")
-
-                        left, spacer, right = st.columns([2, 1, 2])
-
-                        try:
-                            budget_str = str(st.session_state.get("total_budget", "0"))
-                            budget_clean = re.sub(r"[^\d.]", "", budget_str)
-                            total_cost = float(budget_clean) if budget_clean else 0.0
-                            duration = st.session_state.get("plan_duration", 1)
-
-                            if total_cost > 0:
-                                left.metric(
-                                    "Total Cost",
-                                    f"₹{total_cost:,.0f}"
-                                )
-
-                                right.metric(
-                                    "Daily Average",
-                                    f"₹{total_cost / duration:,.0f} / day"
-                                )
-                            else:
-                                left.metric("Total Cost", "₹--")
-                                right.metric("Daily Average", "₹--")
-
-                        except Exception:
-                            left.metric("Total Cost", "₹--")
-                            right.metric("Daily Average", "₹--")
-                    
-                    # Store plan
-                    st.session_state['pending_plan'] = final_plan
-                    st.session_state['total_budget'] = cost
-                    st.session_state['plan_duration'] = duration
-                    st.session_state['feedback_mode'] = False
-                    
-                    st.session_state['live_chat'].append({"role": "assistant", "content": f"✅ I've created a new {duration}-day plan. Check the 'Proposed Strategy' section above."})
-                    st.rerun()
-                else:
-                    # No duration specified, ask for it
-                    reply = "How many days should I plan for?"
-                    st.session_state['live_chat'].append({"role": "assistant", "content": reply})
-                    st.rerun()
+                intent = intent_data.get("intent", "GENERAL_QUESTION")
+                duration = intent_data.get("duration")
+                req_meals = intent_data.get("meals_per_day") or u_data.meals_per_day
+                feedback_text = intent_data.get("feedback")
             
-            elif intent == "ANSWER_DURATION":
-                # User is answering a duration question
-                try:
+                # 3. DYNAMIC ROUTING BASED ON DETECTED INTENT
+                if intent == "CREATE_PLAN":
+                    # User wants to create a new plan
                     if duration:
-                        if duration > 7: duration = 7
-                        if duration < 1: duration = 1
-                        
-                        with st.status(f"🚀 Crafting {duration}-Day Strategy...", expanded=True) as status:
-                            obj = "Weight Loss" if u_data[6] > u_data[7] else "Muscle Gain"
+                        if duration > 7:
+                            st.session_state['live_chat'].append({"role": "assistant", "content": "⚠️ Limit is 7 days. Generating a 7-day plan..."})
+                            duration = 7
+                        if duration < 1:
+                            duration = 1
+
+                        # Generate new plan
+                        with st.status(f"👨‍🍳 Designing {req_meals}-Meal Strategy for {duration} Days...", expanded=True) as status:
+                            obj = plan_objective(u_data)
                             final_plan, cost = generate_plan_workflow(
-                                u_data[0], u_data[3], u_data[6], u_data[5], u_data[4], u_data[8], 
-                                obj, duration, u_data[13], u_data[10], u_data[12], u_data[9]
+                                u_data, obj, duration, req_meals
                             )
-                        status.update(label="✅ Strategy Finalized!", state="complete", expanded=False)
-                        
-                        with st.container(border=True):
-                            st.markdown("### 💰 Financial Forecast")
-
-                            left, spacer, right = st.columns([2, 1, 2])
-
-                            try:
-                                budget_str = str(st.session_state.get("total_budget", "0"))
-                                budget_clean = re.sub(r"[^\d.]", "", budget_str)
-                                total_cost = float(budget_clean) if budget_clean else 0.0
-                                duration = st.session_state.get("plan_duration", 1)
-
-                                if total_cost > 0:
-                                    left.metric(
-                                        "Total Cost",
-                                        f"₹{total_cost:,.0f}"
-                                    )
-
-                                    right.metric(
-                                        "Daily Average",
-                                        f"₹{total_cost / duration:,.0f} / day"
-                                    )
-                                else:
-                                    left.metric("Total Cost", "₹--")
-                                    right.metric("Daily Average", "₹--")
-
-                            except Exception:
-                                left.metric("Total Cost", "₹--")
-                                right.metric("Daily Average", "₹--")
-                        
+                        status.update(label="✅ Strategy Ready!", state="complete", expanded=False)
+                    
+                        # Store plan
                         st.session_state['pending_plan'] = final_plan
                         st.session_state['total_budget'] = cost
                         st.session_state['plan_duration'] = duration
-                        st.session_state['live_chat'].append({"role": "assistant", "content": "✅ Plan generated! You can review it above."})
+                        st.session_state['feedback_mode'] = False
+                    
+                        st.session_state['live_chat'].append({"role": "assistant", "content": f"✅ I've created a new {duration}-day plan. Check the 'Proposed Strategy' section above."})
                         st.rerun()
                     else:
-                        raise ValueError("No duration extracted")
-                except:
-                    reply = "I need a number (1-7). How many days?"
-                    st.session_state['live_chat'].append({"role": "assistant", "content": reply})
-                    st.rerun()
-                                
-            elif intent == "REGENERATE_PLAN":
-                # User wants to modify/regenerate the existing plan
-                if not has_pending_plan:
-                    # No plan to regenerate, treat as general question
-                    intent = "GENERAL_QUESTION"
-                else:
-                    stored_duration = st.session_state.get('plan_duration', 7)
-                    
-                    # Get previous cost for relative adjustment
-                    prev_cost_str = st.session_state.get('total_budget', '0')
+                        # No duration specified, ask for it
+                        reply = "How many days should I plan for?"
+                        st.session_state['live_chat'].append({"role": "assistant", "content": reply})
+                        st.rerun(scope="fragment") # Only the chat changed
+            
+                elif intent == "ANSWER_DURATION":
+                    # User is answering a duration question
                     try:
-                        prev_cost_clean = re.sub(r'[^\d.]', '', str(prev_cost_str))
-                        previous_cost = float(prev_cost_clean) if prev_cost_clean else None
-                    except:
-                        previous_cost = None
-                    
-                    # Regenerate plan with feedback
-                    with st.status(f"🔄 Regenerating Plan Based on Your Feedback...", expanded=True) as status:
-                        obj = "Weight Loss" if u_data[6] > u_data[7] else "Muscle Gain"
+                        if not duration:
+                            raise ValueError("No duration extracted")
+                        duration = min(max(int(duration), 1), 7)
+                    except ValueError:
+                        reply = "I need a number (1-7). How many days?"
+                        st.session_state['live_chat'].append({"role": "assistant", "content": reply})
+                        st.rerun(scope="fragment") # Only the chat changed
+
+                    # Outside the try: st.rerun() raises Streamlit's RerunException
+                    with st.status(f"🚀 Crafting {duration}-Day Strategy...", expanded=True) as status:
+                        obj = plan_objective(u_data)
                         final_plan, cost = generate_plan_workflow(
-                            u_data[0], u_data[3], u_data[6], u_data[5], u_data[4], u_data[8], 
-                            obj, stored_duration, u_data[13], u_data[10], u_data[12], u_data[9],
-                            feedback=feedback_text or user_msg,
-                            previous_cost=previous_cost
+                            u_data, obj, duration, u_data.meals_per_day
                         )
-                    status.update(label="✅ Plan Regenerated!", state="complete", expanded=False)
-                    
-                    with st.container(border=True):
-                        st.markdown("### 💰 Financial Forecast")
-
-                        left, spacer, right = st.columns([2, 1, 2])
+                    status.update(label="✅ Strategy Finalized!", state="complete", expanded=False)
 
-                        try:
-                            budget_str = str(st.session_state.get("total_budget", "0"))
-                            budget_clean = re.sub(r"[^\d.]", "", budget_str)
-                            total_cost = float(budget_clean) if budget_clean else 0.0
-                            duration = st.session_state.get("plan_duration", 1)
-
-                            if total_cost > 0:
-                                left.metric(
-                                    "Total Cost",
-                                    f"₹{total_cost:,.0f}"
-                                )
-
-                                right.metric(
-                                    "Daily Average",
-                                    f"₹{total_cost / duration:,.0f} / day"
-                                )
-                            else:
-                                left.metric("Total Cost", "₹--")
-                                right.metric("Daily Average", "₹--")
-
-                        except Exception:
-                            left.metric("Total Cost", "₹--")
-                            right.metric("Daily Average", "₹--")
-                    
-                    # Update the pending plan
                     st.session_state['pending_plan'] = final_plan
                     st.session_state['total_budget'] = cost
-                    st.session_state['plan_duration'] = stored_duration
-                    st.session_state['feedback_mode'] = False
+                    st.session_state['plan_duration'] = duration
+                    st.session_state['live_chat'].append({"role": "assistant", "content": "✅ Plan generated! You can review it above."})
+                    st.rerun() # Full rerun so the Proposed Strategy section shows the new plan
+                                
+                elif intent == "REGENERATE_PLAN":
+                    # User wants to modify/regenerate the existing plan
+                    if not has_pending_plan:
+                        # No plan to regenerate, treat as general question
+                        intent = "GENERAL_QUESTION"
+                    else:
+                        stored_duration = st.session_state.get('plan_duration', 7)
                     
-                    st.session_state['live_chat'].append({
-                        "role": "assistant", 
-                        "content": f"✅ I've regenerated your plan considering your feedback. Check the updated 'Proposed Strategy' section above."
-                    })
-                    st.rerun()
+                        # Get previous cost for relative adjustment
+                        prev_cost_str = st.session_state.get('total_budget', '0')
+                        try:
+                            prev_cost_clean = strip_cost(str(prev_cost_str))
+                            previous_cost = float(prev_cost_clean) if prev_cost_clean else None
+                        except:
+                            previous_cost = None
+                    
+                        # Regenerate plan with feedback
+                        with st.status(f"🔄 Regenerating Plan Based on Your Feedback...", expanded=True) as status:
+                            obj = plan_objective(u_data)
+                            final_plan, cost = generate_plan_workflow(
+                                u_data, obj, stored_duration, u_data.meals_per_day,
+                                feedback=feedback_text or user_msg,
+                                previous_cost=previous_cost
+                            )
+                        status.update(label="✅ Plan Regenerated!", state="complete", expanded=False)
+                    
+                        # Update the pending plan
+                        st.session_state['pending_plan'] = final_plan
+                        st.session_state['total_budget'] = cost
+                        st.session_state['plan_duration'] = stored_duration
+                        st.session_state['feedback_mode'] = False
+                    
+                        st.session_state['live_chat'].append({
+                            "role": "assistant", 
+                            "content": f"✅ I've regenerated your plan considering your feedback. Check the updated 'Proposed Strategy' section above."
+                        })
+                        st.rerun()
             
-            # GENERAL_QUESTION or fallback
-            if intent == "GENERAL_QUESTION":
-                # General Chat (Ingredients, Doubts, Etc.)
-                # 1. Check if there is a PROPOSED (Pending) Plan on screen
-                active_tab = st.session_state.get("active_tab", "tab1")
-
-                pending_plan = st.session_state.get("pending_plan")
-                approved_plan = get_latest_approved_context(u_data[0])
-
-                if active_tab == "tab2":
-                    # USER IS IN VISUAL TRACKER → IMAGE CONTEXT FIRST
-                    plan_context = """
-                    USER IS CURRENTLY IN FOOD DIARY / IMAGE ANALYSIS MODE.
-                    Focus on the most recent food image analysis and its implications.
-                    Do NOT prioritize meal plans unless explicitly asked.
-                    """
-                elif pending_plan:
-                    # USER IS IN TAB1 OR TAB3 WITH A PLAN ON SCREEN
-                    plan_context = f"""
-                    CURRENT STATUS: User has a PROPOSED STRATEGY on screen (Not yet approved).
-                    Focus on answering questions about THIS plan.
-
-                    DETAILS:
-                    {pending_plan[:2500]}...
-                    """
-                else:
-                    plan_context = f"""
-                    CURRENT STATUS: No active plan.
-                    Refer to last approved history.
-
-                    LAST APPROVED PLAN:
-                    {approved_plan[:1500]}...
-                    """
-
-
-                # 4. Final Context String
-                memory = st.session_state.get("agent_memory", {})
-                food_logs = (
-                    st.session_state
-                    .get("agent_memory", {})
-                    .get("tabs", {})
-                    .get("tab2", {})
-                    .get("food_diary", [])
-                )
-
-                last_image = (
-                    st.session_state
-                    .get("agent_memory", {})
-                    .get("tabs", {})
-                    .get("tab2", {})
-                    .get("last_image_analysis")
-                )
-                
-                recent_food_log = ""
-                if last_image:
-                    recent_food_log = (
-                        f"- {last_image['timestamp']}: "
-                        f"{last_image['analysis']} "
-                        f"(🌍 {last_image.get('co2', 'N/A')} kg CO₂e)"
-                    )
-                else:
-                    recent_food_log = "No food images analyzed yet."
+                # GENERAL_QUESTION or fallback
+                if intent == "GENERAL_QUESTION":
+                    # General Chat (Ingredients, Doubts, Etc.)
+                    # 1. Check if there is a PROPOSED (Pending) Plan on screen
+                    active_tab = st.session_state.get("active_tab", "tab1")
+
+                    pending_plan = st.session_state.get("pending_plan")
+
+                    if active_tab == "tab2":
+                        # USER IS IN VISUAL TRACKER → IMAGE CONTEXT FIRST
+                        plan_context = """
+                        USER IS CURRENTLY IN FOOD DIARY / IMAGE ANALYSIS MODE.
+                        Focus on the most recent food image analysis and its implications.
+                        Do NOT prioritize meal plans unless explicitly asked.
+                        """
+                    elif pending_plan:
+                        # USER IS IN TAB1 OR TAB3 WITH A PLAN ON SCREEN
+                        plan_context = f"""
+                        CURRENT STATUS: User has a PROPOSED STRATEGY on screen (Not yet approved).
+                        Focus on answering questions about THIS plan.
+
+                        DETAILS:
+                        {plan_summary(pending_plan, 2500)}
+                        """
+                    else:
+                        # Only this branch needs the approved plan, so only it pays the (cached) lookup
+                        approved_plan = get_latest_approved_context(u_data.email)
+                        plan_context = f"""
+                        CURRENT STATUS: No active plan.
+                        Refer to last approved history.
 
-                memory = st.session_state.get("agent_memory") or {}
-                carbon = memory.get("carbon_metrics") or {}
+                        LAST APPROVED PLAN:
+                        {plan_summary(approved_plan, 1500)}
+                        """
 
-                active_tab = st.session_state.get("active_tab", "tab1")
-                agent_memory = st.session_state.get("agent_memory", {})
 
-                global_mem = agent_memory.get("global", {})
-                tab_mem = agent_memory.get("tabs", {}).get(active_tab, {})
+                    # 4. Final Context String
+                    # One SessionState lookup; every read below goes through this plain dict
+                    mem = st.session_state["agent_memory"]
+                    last_image = mem["tabs"]["tab2"].get("last_image_analysis")
                 
-                user_context = f"""
-                USER PROFILE:
-                Age: {u_data[3]}
-                Weight: {u_data[6]} kg → Goal: {u_data[7]} kg
-                Diet: {u_data[10]}, Cuisine: {u_data[13]}
-
-                PRIMARY CONTEXT (ACTIVE TAB: {active_tab}):
-                {tab_mem if tab_mem else "No tab-specific context yet."}
-
-                SECONDARY CONTEXT (GLOBAL MEMORY):
-                {global_mem if global_mem else "No global memory yet."}
-
-                LEGACY CONTEXT (COMPATIBILITY):
-                Meal Plan:
-                {agent_memory.get("meal_plan", "No plan generated yet.")}
-
-                Budget:
-                ₹{agent_memory.get("total_budget", "N/A")}
-
-                Carbon Analysis:
-                CO₂: {agent_memory.get("carbon_metrics", {}).get("co2", "N/A")}
-                Score: {agent_memory.get("carbon_metrics", {}).get("score", "N/A")}
+                    recent_food_log = ""
+                    if last_image:
+                        recent_food_log = (
+                            f"- {last_image['timestamp']}: "
+                            f"{last_image['analysis']} "
+                            f"(🌍 {last_image.get('co2', 'N/A')} kg CO₂e)"
+                        )
+                    else:
+                        recent_food_log = "No food images analyzed yet."
 
-                Food Diary:
-                {recent_food_log}
-                """
+                    global_mem = mem.get("global", {})
+                    tab_mem = mem.get("tabs", {}).get(active_tab, {})
                 
-                # 5. Get Reply
-                bot_reply = live_chat_reply(st.session_state['live_chat'], user_context)
-                st.session_state['live_chat'].append({"role": "assistant", "content": bot_reply})
-                st.rerun()
-            
-
-    with tab2:
-        st.session_state["active_tab"] = "tab2"
-        st.header("🍽️ Food Diary")
-
+                    carbon = mem.get("carbon_metrics", {})
+                    user_context = CHAT_CONTEXT_TEMPLATE.substitute(
+                        age=u_data.age, weight=u_data.weight, goal_weight=u_data.goal_weight,
+                        diet=u_data.diet_type, cuisine=u_data.cuisine,
+                        active_tab=active_tab,
+                        tab_memory=tab_mem if tab_mem else "No tab-specific context yet.",
+                        global_memory=global_mem if global_mem else "No global memory yet.",
+                        plan_context=plan_context.strip(),
+                        meal_plan=mem.get("meal_plan", "No plan generated yet."),
+                        total_budget=mem.get("total_budget", "N/A"),
+                        co2=carbon.get("co2", "N/A"), score=carbon.get("score", "N/A"),
+                        recent_food_log=recent_food_log
+                    )
+                
+                    # 5. Get Reply
+                    with st.chat_message("assistant"):
+                        bot_reply = st.write_stream(live_chat_reply(st.session_state['live_chat'], user_context, u_data.email))
+                    st.session_state['live_chat'].append({"role": "assistant", "content": bot_reply})
+                    st.rerun(scope="fragment") # Only the chat changed
+
+    chat_panel()
+
+    # --- FOOD DIARY ---
+    # Also a fragment: uploading and previewing a photo reruns only this panel; a logged meal reruns the app
+    @st.fragment
+    def food_diary_panel():
         # --- Upload image ---
         uploaded_image = st.file_uploader(
             "Upload meal photo...",
@@ -1752,8 +2205,9 @@ else:
 
         # --- FIX: Only reset if the file is NEW ---
         if uploaded_image is not None:
-            # Create a unique ID for the file
-            file_id = f"{uploaded_image.name}_{uploaded_image.size}"
+            # Streamlit's per-upload id: two photos sharing a name and size no longer collide,
+            # and nothing is hashed on reruns (identical bytes are deduplicated by analyze_image)
+            file_id = uploaded_image.file_id
             
             # Check if this is a DIFFERENT file than before
             if st.session_state.get("last_uploaded_file_id") != file_id:
@@ -1769,10 +2223,11 @@ else:
 
         # --- Display image ---
         if current_image is not None:
-            st.image(current_image, caption="Current meal under analysis", width=300)
+            st.image(prep_meal_image(current_image.getvalue()), caption="Current meal under analysis", width=300)
 
             # --- Analyze button ---
-            if st.button("Analyze", key="analyze_food_btn"):
+            # Debounced per photo: once analysed, a re-click would only re-log the same meal
+            if st.button("Analyze", key="analyze_food_btn", disabled=bool(st.session_state.get("food_analysis_done"))):
                 with st.spinner("🔍 AI is analyzing your food..."):
                     analysis_result = analyze_image(current_image)
                     st.session_state["food_analysis_result"] = analysis_result
@@ -1790,9 +2245,13 @@ else:
 
                     tab2_memory = st.session_state["agent_memory"]["tabs"]["tab2"]
 
+                    save_food_log(u_data.email, entry)
                     tab2_memory["food_diary"].append(entry)
                     tab2_memory["last_image_analysis"] = entry
 
+                # A new diary entry changes the Eco tab too, so redraw the whole app, not just this panel
+                st.rerun()
+
 
             # --- Show analysis ---
             if st.session_state.get("food_analysis_done"):
@@ -1809,84 +2268,91 @@ else:
 
                 st.markdown("---")
 
-                
-
+    with tab2:
+        st.session_state["active_tab"] = "tab2"
+        st.header("🍽️ Food Diary")
+        food_diary_panel()
 
     with tab3:
         st.session_state["active_tab"] = "tab3"
         st.header("🌍 Ecological Impact Of Meal")
 
+        # Set by the tab3 widget callbacks below, so only runs started from this tab may prefetch
+        eco_tab_used = st.session_state.pop("eco_tab_used", False)
+
         analysis_mode = st.radio(
             "Choose analysis source",
-            ["Planned Meal (Strategy)", "Actual Meals (Photos)"],
-            horizontal=True
+            ECO_ANALYSIS_MODES,
+            horizontal=True,
+            on_change=mark_eco_tab_used
         )
 
         # --- CONTEXT BUILDER ---
-        if analysis_mode == "Planned Meal (Strategy)":
+        if analysis_mode == ECO_ANALYSIS_MODES[0]:
             if 'current_strategy' not in st.session_state:
                 st.warning("⚠️ Please generate a Meal Plan in the 'Strategic Planner' tab first.")
                 st.stop()
 
             analysis_context = st.session_state['current_strategy']
-            analysis_label = "PLANNED MEAL STRATEGY"
+            local_co2 = None
 
         else:
-            tab2_memory = st.session_state["agent_memory"]["tabs"]["tab2"]
-            food_logs = tab2_memory.get("food_diary", [])
+            # Read from the database so meals logged in earlier sessions count too;
+            # cached until the next diary entry, so reruns don't rebuild it
+            analysis_context = get_food_log_context(u_data.email)
 
-            if not food_logs:
+            if not analysis_context:
                 st.warning("⚠️ No food photos analyzed yet. Use the Visual Tracker first.")
                 st.stop()
 
-            analysis_context = "\n".join([
-                f"- {f['analysis']} (CO₂: {f.get('co2', 'N/A')} kg)"
-                for f in food_logs[-5:]
-            ])
-            analysis_label = "ACTUAL CONSUMED MEALS"
+            # A diary of only low-impact meals gets a near-fixed verdict; the stored estimates are enough
+            local_co2 = get_low_impact_co2_total(u_data.email)
 
-        st.caption(f"Analyzing **{analysis_label.lower()}**")
+        st.caption(f"Analyzing **{ECO_ANALYSIS_LABELS[analysis_mode].lower()}**")
 
         # --- PREVENT REDUNDANT ANALYSIS ---
         tab3_memory = st.session_state["agent_memory"]["tabs"]["tab3"]
         current_fingerprint = hash((analysis_mode, analysis_context))
         last_fingerprint = tab3_memory.get("last_fingerprint")
 
-        if st.button("🌱 Calculate Carbon Footprint"):
+        calculate = st.button("🌱 Calculate Carbon Footprint", on_click=mark_eco_tab_used)
+
+        # Once the user has run an analysis this session and is working in this tab, start the report
+        # for a changed context in the background so the button usually finds it already finished
+        eco_prefetch = st.session_state.setdefault("eco_prefetch", {})   # fingerprint -> Future
+        if (not calculate and eco_tab_used and local_co2 is None
+                and last_fingerprint is not None and last_fingerprint != current_fingerprint):
+            prefetch_eco_report(eco_prefetch, analysis_mode, analysis_context)
+
+        if calculate:
             if last_fingerprint == current_fingerprint:
                 st.info("ℹ️ No change detected. Showing previous analysis.")
             else:
                 with st.status("♻️ Environmental Analyst is auditing...", expanded=True):
 
-                    eco_prompt = f"""
-                    You are an Environmental Scientist.
-
-                    Analyze the following food data:
-                    {analysis_context}
-
-                    TASKS:
-                    1. Estimate total carbon footprint (kg CO2e)
-                    2. Assign a sustainability score (0–100)
+                    if local_co2 is not None:
+                        est_co2, sust_score, clean_report = local_co2, LOW_IMPACT_SCORE, LOW_IMPACT_ECO_REPORT
+                    else:
+                        prefetched = eco_prefetch.pop(current_fingerprint, None)
 
-                    OUTPUT FORMAT (STRICT):
-                    ### CO2: 12.5 ###
-                    ### SCORE: 75 ###
-                    <short explanation>
-                    """
+                        # Start the other source's report alongside this one, so switching the radio
+                        # after this analysis finds it finished instead of waiting a second round trip
+                        other_mode = ECO_ANALYSIS_MODES[analysis_mode == ECO_ANALYSIS_MODES[0]]
+                        other_context = eco_llm_context(other_mode, u_data.email)
+                        other_fingerprint = hash((other_mode, other_context))
 
-                    eco_report = run_agent(
-                        "Environmental Analyst",
-                        "You are a precise environmental scientist.",
-                        eco_prompt
-                    )
+                        # Reports for snapshots that are no longer current would never be read
+                        for fingerprint in [f for f in eco_prefetch if f != other_fingerprint]:
+                            eco_prefetch.pop(fingerprint).cancel()
 
-                    co2_match = re.search(r"###\s*CO2:\s*([\d\.]+)", eco_report)
-                    score_match = re.search(r"###\s*SCORE:\s*([\d]+)", eco_report)
+                        if other_context:
+                            prefetch_eco_report(eco_prefetch, other_mode, other_context)
+                        if prefetched:
+                            eco_report = prefetched.result()
+                        else:
+                            eco_report = build_eco_report(analysis_mode, analysis_context)
 
-                    est_co2 = float(co2_match.group(1)) if co2_match else 0.0
-                    sust_score = int(score_match.group(1)) if score_match else 50
-
-                    clean_report = re.sub(r"###.*?###", "", eco_report).strip()
+                        est_co2, sust_score, clean_report = parse_eco_report(eco_report)
 
                     # --- SHORT SUMMARY ---
                     summary = (
@@ -1895,37 +2361,20 @@ else:
                         "High impact 🚨"
                     )
 
-                    tab3_memory.update({
-                        "carbon_metrics": {
-                            "co2": est_co2,
-                            "score": sust_score
-                        },
-                        "carbon_report": clean_report,
-                        "analysis_source": analysis_mode,
-                        "summary": summary,
-                        "last_fingerprint": current_fingerprint
-                    })
+                    # Assign the slots directly rather than building a throwaway dict for .update()
+                    tab3_memory["carbon_metrics"] = {"co2": est_co2, "score": sust_score}
+                    tab3_memory["eco_metrics"] = build_eco_metrics(est_co2, sust_score)
+                    tab3_memory["carbon_report"] = clean_report
+                    tab3_memory["analysis_source"] = analysis_mode
+                    tab3_memory["summary"] = summary
+                    tab3_memory["last_fingerprint"] = current_fingerprint
 
         # --- DISPLAY FROM MEMORY ---
-        metrics = tab3_memory.get("carbon_metrics")
-        report = tab3_memory.get("carbon_report")
-        source = tab3_memory.get("analysis_source")
-        summary = tab3_memory.get("summary")
-
+        metrics = tab3_memory.get("eco_metrics")
         if metrics:
-            st.subheader(f"📊 Impact Dashboard — {source}")
-
-            m1, m2, m3 = st.columns(3)
-            m1.metric("Est. Carbon Emissions", f"{metrics['co2']:.2f} kg CO₂e")
-            m2.metric("Equivalent Car Travel", f"{metrics['co2'] * 4:.1f} km")
-            m3.metric("Trees Needed to Offset", f"{metrics['co2'] / 20:.1f} trees/year")
-
-            st.progress(metrics['score'] / 100)
-            st.caption(f"Sustainability Score: {metrics['score']}/100")
-
-            if summary:
-                st.success(f"**Summary:** {summary}")
-
-            if report:
-                with st.expander("📝 Scientist’s Explanation", expanded=True):
-                    st.write(report)
+            render_eco_dashboard(
+                metrics,
+                tab3_memory.get("analysis_source"),
+                tab3_memory.get("summary"),
+                tab3_memory.get("carbon_report"),
+            )